@@ -1,4 +1,6 @@
 import struct
+import array
+import sys
 import xml.etree.ElementTree as ET
 import uuid
 import math
@@ -6,145 +8,594 @@ import pprint
 import os
 import html
 import argparse
+import random
+import contextlib
+import concurrent.futures
+import hashlib
+import json
+import marshal
+import time
+import shutil
+import tarfile
+import io
+import threading
+import queue
+import collections
+import sqlite3
+import pathlib
+try:
+	import resource
+except ImportError:
+	# Not available on Windows
+	resource = None
+
+try:
+	# Optional, makes sample format conversion a lot faster
+	import numpy
+except ImportError:
+	numpy = None
 
 
 AU_SAMPLE_FORMAT_16 = 3
 AU_SAMPLE_FORMAT_24 = 4
 AU_SAMPLE_FORMAT_FLOAT = 6
 
+AU_MAGIC = 0x2e736e64
+AU_MAGIC_SWAPPED = 0x646e732e
+AU_HEADER_SIZE = 6 * 4
+
+# Size in bytes of one sample in the .au file, for each encoding
+AU_SAMPLE_SIZES = {
+	AU_SAMPLE_FORMAT_16: 2,
+	AU_SAMPLE_FORMAT_24: 3,
+	AU_SAMPLE_FORMAT_FLOAT: 4
+}
+
+# Typecode of the `array` we decode each encoding into.
+# 24-bit samples don't have a native type, so they get sign-extended into 32-bit integers.
+AU_SAMPLE_TYPECODES = {
+	AU_SAMPLE_FORMAT_16: 'h',
+	AU_SAMPLE_FORMAT_24: 'i',
+	AU_SAMPLE_FORMAT_FLOAT: 'f'
+}
+
+# Maps the most significant byte of a 24-bit sample to the byte that sign-extends it to 32 bits
+_SIGN_EXTENSION_TABLE = bytes(0xff if i & 0x80 else 0 for i in range(256))
+
+
+def read_au_header(f):
+	# See https://github.com/audacity/audacity/blob/master/src/blockfile/SimpleBlockFile.cpp
+
+	# wxUint32 magic;      // magic number
+	# wxUint32 dataOffset; // byte offset to start of audio data
+	# wxUint32 dataSize;   // data length, in bytes (optional)
+	# wxUint32 encoding;   // data encoding enumeration
+	# wxUint32 sampleRate; // samples per second
+	# wxUint32 channels; // number of interleaved channels
+
+	d = f.read(AU_HEADER_SIZE)
+	if len(d) != AU_HEADER_SIZE:
+		print("ERROR: .au file is too small to contain a header")
+		return None
+
+	# Audacity writes block files in the byte order of the machine that saved them,
+	# so if the magic number looks reversed, the whole file was written with the other one.
+	swapped = False
+	hdata = struct.unpack('=6I', d)
+	if hdata[0] == AU_MAGIC_SWAPPED:
+		swapped = True
+		hdata = struct.unpack(('>' if sys.byteorder == 'little' else '<') + '6I', d)
+	elif hdata[0] != AU_MAGIC:
+		print("ERROR: Not an .au file, magic number is ", hex(hdata[0]))
+		return None
+
+	return {
+		'magic': hdata[0],
+		'data_offset': hdata[1],
+		'data_size': hdata[2],
+		'encoding': hdata[3],
+		'sample_rate': hdata[4],
+		'channels': hdata[5],
+		'swapped': swapped
+	}
+
+
+def decode_au_samples(data, encoding, swapped=False):
+	# Decodes raw .au sample data in one go into a typed `array`.
+	# Trailing bytes that don't make a whole sample are ignored.
+
+	ss = AU_SAMPLE_SIZES[encoding]
+	count = len(data) // ss
+	if count * ss != len(data):
+		data = memoryview(data)[:count * ss]
+
+	if encoding == AU_SAMPLE_FORMAT_24:
+		# Spread bytes into 32-bit little-endian slots with strided copies,
+		# and fill the top byte with the sign of each sample
+		data = bytes(data)
+		file_is_little_endian = (sys.byteorder == 'little') != swapped
+		if file_is_little_endian:
+			lo, mid, hi = data[0::3], data[1::3], data[2::3]
+		else:
+			hi, mid, lo = data[0::3], data[1::3], data[2::3]
+		buf = bytearray(count * 4)
+		buf[0::4] = lo
+		buf[1::4] = mid
+		buf[2::4] = hi
+		buf[3::4] = hi.translate(_SIGN_EXTENSION_TABLE)
+		samples = array.array('i')
+		samples.frombytes(buf)
+		if sys.byteorder != 'little':
+			samples.byteswap()
+		return samples
+
+	samples = array.array(AU_SAMPLE_TYPECODES[encoding])
+	samples.frombytes(data)
+	if swapped:
+		samples.byteswap()
+	return samples
+
 
 def load_au_file(au_fpath):
 	with open(au_fpath, 'rb') as f:
 
-		# See https://github.com/audacity/audacity/blob/master/src/blockfile/SimpleBlockFile.cpp
-
-		# wxUint32 magic;      // magic number
-		# wxUint32 dataOffset; // byte offset to start of audio data
-		# wxUint32 dataSize;   // data length, in bytes (optional)
-		# wxUint32 encoding;   // data encoding enumeration
-		# wxUint32 sampleRate; // samples per second
-		# wxUint32 channels; // number of interleaved channels
-
-		hcount = 6
-		hdata = struct.unpack('I' * hcount, f.read(hcount * 4))
-
-		result = {
-			'magic': hdata[0],
-			'data_offset': hdata[1],
-			'data_size': hdata[2],
-			'encoding': hdata[3],
-			'sample_rate': hdata[4],
-			'channels': hdata[5]
-		}
+		result = read_au_header(f)
+		if result is None:
+			return
 
 		#print(result)
 
-		if result['magic'] == 0x2e736e64:
-			encoding = result['encoding']
-		else:
-			print("ERROR: Endianess needs to be swapped but I dunno what to do")
+		encoding = result['encoding']
+
+		if encoding not in AU_SAMPLE_SIZES:
+			print("ERROR: I dunno this format ", encoding)
 			return
 
 		f.seek(result['data_offset'])
 
 		ds = result['data_size']
 
-		#if ds == 0xffffffff:
-			# Size was specified as optional... read to end of file I guess?
-			#ds = -1
+		# Size is optional, in which case we read to the end of the file.
+		# Note: the file may be very big, but reading it in one call is still
+		# way cheaper than going through Python objects sample by sample.
+		if ds == 0xffffffff:
+			data = f.read()
+		else:
+			data = f.read(ds)
 
-		if encoding == AU_SAMPLE_FORMAT_16:
-			sfc = 'h'
-			ss = 2
-		elif encoding == AU_SAMPLE_FORMAT_24:
-			print("ERROR: 24-bit samples? Dunno how to read them")
-			return
-		elif encoding == AU_SAMPLE_FORMAT_FLOAT:
-			sfc = 'f'
-			ss = 4
+	print('    ', result)
+
+	result['sample_data'] = decode_au_samples(data, encoding, result['swapped'])
+
+	return result
+
+
+class AuReader:
+	# Streams samples out of an .au block file, one chunk at a time.
+	# Use open_au_file() to get one.
+
+	def __init__(self, f, header):
+		self.f = f
+		self.header = header
+		self.encoding = header['encoding']
+		self.sample_rate = header['sample_rate']
+		self.channels = header['channels']
+		self.sample_size = AU_SAMPLE_SIZES[self.encoding]
+
+		ds = header['data_size']
+		# Size is optional, in which case we read to the end of the file
+		self.remaining_size = None if ds == 0xffffffff else ds
+
+		# Whether samples are stored the way WAV files store them
+		self.is_little_endian = (sys.byteorder == 'little') != header['swapped']
+
+	def get_remaining_samples(self):
+		# Returns how many samples are left to read, as found in the file rather than in its header
+		pos = self.f.tell()
+		size = self.f.seek(0, os.SEEK_END) - pos
+		self.f.seek(pos)
+		if self.remaining_size is not None:
+			size = min(size, self.remaining_size)
+		return max(0, size) // self.sample_size
+
+	def can_copy_data_to(self, writer):
+		# Tells if samples can go into the WavWriter as they are, see copy_data_to()
+		return (self.is_little_endian
+			and writer.channels == self.channels
+			and writer.sample_rate == self.sample_rate
+			and AU_ENCODING_OUTPUT_FORMATS[self.encoding] == get_output_format_name(writer))
+
+	def copy_data_to(self, writer, count):
+		# Copies up to `count` samples into the WAV file without decoding them.
+		# Returns how many samples were copied.
+		size = count * self.sample_size
+		if self.remaining_size is not None:
+			size = min(size, self.remaining_size)
+		copied = writer.append_raw_data_from_file(self.f, size)
+		if self.remaining_size is not None:
+			self.remaining_size -= copied * self.sample_size
+		return copied
+
+	def read(self, count):
+		# Returns up to `count` samples as a typed `array`, which is empty once the end is reached
+		size = count * self.sample_size
+		if self.remaining_size is not None:
+			size = min(size, self.remaining_size)
+		data = self.f.read(size)
+		if self.remaining_size is not None:
+			self.remaining_size -= len(data)
+		return decode_au_samples(data, self.encoding, self.header['swapped'])
+
+	def close(self):
+		self.f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+
+def open_au_file(au_fpath, data=None):
+	# Returns an AuReader, or None if the file can't be read.
+	# If the content of the file was already loaded, it can be given as `data`.
+	f = open(au_fpath, 'rb') if data is None else io.BytesIO(data)
+
+	header = read_au_header(f)
+	if header is None:
+		f.close()
+		return None
+
+	if header['encoding'] not in AU_SAMPLE_SIZES:
+		print("ERROR: I dunno this format ", header['encoding'])
+		f.close()
+		return None
+
+	print('    ', header)
+
+	f.seek(header['data_offset'])
+	return AuReader(f, header)
+
+
+# Audacity 3 projects (.aup3) are SQLite databases, where blocks are rows of the `sampleblocks` table.
+# Blocks of these projects are referred to with this instead of a file path.
+SqliteBlock = collections.namedtuple('SqliteBlock', ('db_path', 'blockid', 'sample_rate'))
+
+# .au encoding corresponding to each `sampleformat` of Audacity.
+# Unlike in .au files, 24-bit samples are stored in 32-bit integers.
+SQLITE_SAMPLE_FORMAT_ENCODINGS = {
+	0x00020001: AU_SAMPLE_FORMAT_16,
+	0x00040001: AU_SAMPLE_FORMAT_24,
+	0x0004000F: AU_SAMPLE_FORMAT_FLOAT
+}
+
+# Maximum number of parameters in a query, SQLite can be built with a limit as low as 999
+SQLITE_BATCH_SIZE = 500
+
+# Connections by (database path, process, thread), opened on first use.
+# The process is part of it because worker processes can be forked with a copy of this,
+# and connections must not be used across a fork.
+_sqlite_connections = {}
+# (sample format, size in bytes) of blocks, by database path and block id
+_sqlite_block_info = {}
+
+
+def get_sqlite_connection(db_path):
+	# Returns a read-only connection to a database, for the current thread
+	key = (db_path, os.getpid(), threading.get_ident())
+	connection = _sqlite_connections.get(key)
+	if connection is None:
+		uri = pathlib.Path(os.path.abspath(db_path)).as_uri() + '?mode=ro'
+		# Only used by this thread, but closed by close_sqlite_connections() which may run on another
+		connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+		_sqlite_connections[key] = connection
+	return connection
+
+
+def close_sqlite_connections():
+	# Closes connections opened by this process.
+	# Those inherited from a parent process are left alone, they belong to the parent.
+	pid = os.getpid()
+	for key, connection in list(_sqlite_connections.items()):
+		if key[1] == pid:
+			connection.close()
+			del _sqlite_connections[key]
+
+
+def iterate_sqlite_rows_by_id(connection, query, ids):
+	# Runs a query containing `IN ({0})` on batches of ids, and yields all resulting rows
+	ids = sorted(set(ids))
+	for i in range(0, len(ids), SQLITE_BATCH_SIZE):
+		batch = ids[i:i + SQLITE_BATCH_SIZE]
+		for row in connection.execute(query.format(','.join('?' * len(batch))), batch):
+			yield row
+
+
+def prepare_sqlite_blocks(blocks):
+	# Queries information about many blocks at once, so opening them doesn't need a query each
+	ids_by_db_path = {}
+	for block in blocks:
+		if isinstance(block, SqliteBlock):
+			info = _sqlite_block_info.setdefault(block.db_path, {})
+			if block.blockid not in info:
+				ids_by_db_path.setdefault(block.db_path, []).append(block.blockid)
+
+	for db_path, ids in ids_by_db_path.items():
+		info = _sqlite_block_info[db_path]
+		rows = iterate_sqlite_rows_by_id(get_sqlite_connection(db_path),
+			'SELECT blockid, sampleformat, length(samples) FROM sampleblocks WHERE blockid IN ({0}) ORDER BY blockid', ids)
+		for blockid, sample_format, size in rows:
+			info[blockid] = (sample_format, size)
+
+
+def get_sqlite_block_info(block):
+	info = _sqlite_block_info.get(block.db_path, {}).get(block.blockid)
+	if info is None:
+		prepare_sqlite_blocks([block])
+		info = _sqlite_block_info[block.db_path].get(block.blockid)
+		if info is None:
+			raise KeyError("Block {0} not found in {1}".format(block.blockid, block.db_path))
+	return info
+
+
+class SqliteBlockReader:
+	# Streams samples out of a block of an Audacity 3 project, the same way AuReader does.
+	# Samples are read from the database as they are requested, when incremental blob I/O is available.
+
+	def __init__(self, f, sample_format, sample_rate, data_size):
+		self.f = f
+		self.encoding = SQLITE_SAMPLE_FORMAT_ENCODINGS[sample_format]
+		self.sample_rate = sample_rate
+		self.channels = 1
+		self.sample_size = sample_format >> 16
+		self.typecode = AU_SAMPLE_TYPECODES[self.encoding]
+		self.remaining_size = data_size
+		# Audacity stores samples in the byte order of the machine, which is little-endian nowadays
+		self.is_little_endian = True
+
+	def get_remaining_samples(self):
+		return self.remaining_size // self.sample_size
+
+	def can_copy_data_to(self, writer):
+		return False
+
+	def read(self, count):
+		size = min(count * self.sample_size, self.remaining_size)
+		data = self.f.read(size)
+		self.remaining_size -= len(data)
+		samples = array.array(self.typecode)
+		samples.frombytes(data[:len(data) // self.sample_size * self.sample_size])
+		if sys.byteorder != 'little':
+			samples.byteswap()
+		return samples
+
+	def close(self):
+		self.f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+
+def open_sqlite_block(block, data=None):
+	sample_format, size = get_sqlite_block_info(block)
+
+	if sample_format not in SQLITE_SAMPLE_FORMAT_ENCODINGS:
+		print("ERROR: I dunno this format ", sample_format)
+		return None
+
+	if data is not None:
+		f = io.BytesIO(data)
+	else:
+		connection = get_sqlite_connection(block.db_path)
+		if hasattr(connection, 'blobopen'):
+			f = connection.blobopen('sampleblocks', 'samples', block.blockid, readonly=True)
 		else:
-			print("ERROR: I dunno this format ", encoding)
-			return
+			# Python older than 3.11, blocks are small enough to be read at once anyways
+			f = io.BytesIO(read_sqlite_block_data(block))
+
+	return SqliteBlockReader(f, sample_format, block.sample_rate, size)
+
+
+def read_sqlite_block_data(block):
+	row = get_sqlite_connection(block.db_path).execute(
+		'SELECT samples FROM sampleblocks WHERE blockid = ?', (block.blockid,)).fetchone()
+	if row is None:
+		raise KeyError("Block {0} not found in {1}".format(block.blockid, block.db_path))
+	return bytes(row[0])
+
+
+# Where the samples of a block come from can be an .au file path, or a SqliteBlock.
+# These functions deal with both.
+
+def open_block(block, data=None):
+	# Returns an AuReader or a SqliteBlockReader, or None if the block can't be read.
+	# If the block was already loaded, its data can be given.
+	if isinstance(block, SqliteBlock):
+		return open_sqlite_block(block, data)
+	return open_au_file(block, data)
+
+
+def read_block_data(block):
+	if isinstance(block, SqliteBlock):
+		return read_sqlite_block_data(block)
+	return read_file_data(block)
+
+
+def get_block_size(block):
+	if isinstance(block, SqliteBlock):
+		return get_sqlite_block_info(block)[1]
+	return os.path.getsize(block)
+
+
+def get_block_signature(block, base_dir):
+	# Returns something that changes when the content of the block changes, and that can be saved as JSON.
+	# Paths are relative to base_dir, so they don't depend on the working directory,
+	# and stay the same when the project is moved along with base_dir.
+	# Blocks of Audacity 3 projects never change, edits make new ones.
+	if isinstance(block, SqliteBlock):
+		return [get_path_relative_to(block.db_path, base_dir), block.blockid, get_sqlite_block_info(block)[1]]
+	st = os.stat(block)
+	return [get_path_relative_to(block, base_dir), st.st_size, st.st_mtime_ns]
+
+
+def get_path_relative_to(path, base_dir):
+	try:
+		return os.path.relpath(os.path.abspath(path), os.path.abspath(base_dir))
+	except ValueError:
+		# On another drive on Windows
+		return os.path.abspath(path)
+
+
+# Typecode of the `array`s WavWriter takes, for each supported bits per sample and whether samples are float.
+# 24-bit samples are given in 32-bit integers, and packed when written.
+WAV_SAMPLE_TYPECODES = {
+	(16, False): 'h',
+	(24, False): 'i',
+	(32, False): 'i',
+	(32, True): 'f'
+}
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+
+# RIFF sizes are 32-bit. Files with more data are written as RF64 (EBU Tech 3306),
+# which moves the sizes to 64-bit fields of a "ds64" chunk and sets the 32-bit ones to -1.
+RIFF_MAX_CHUNK_SIZE = 0xffffffff
+# riffSize, dataSize and sampleCount on 64 bits, then the length of a table we don't use
+DS64_CHUNK_SIZE = 8 + 8 + 8 + 4
+
+# Size of pieces used to copy data between files when the OS can't do it for us
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def copy_file_data(src_f, dst_f, size):
+	# Copies `size` bytes from the current position of a file to the current position of another,
+	# leaving both positioned after what was copied.
+	# This is done by the kernel where possible, so data doesn't need to come through Python.
+	# Returns how many bytes were copied, which is less than `size` if the source ends earlier.
+	dst_f.flush()
+	src_pos = src_f.tell()
+	dst_pos = dst_f.tell()
+	copied = 0
+
+	try:
+		src_fd = src_f.fileno()
+		dst_fd = dst_f.fileno()
+	except (OSError, ValueError):
+		src_fd = None
+
+	if src_fd is not None and hasattr(os, 'copy_file_range'):
+		try:
+			while copied < size:
+				n = os.copy_file_range(src_fd, dst_fd, size - copied, src_pos + copied, dst_pos + copied)
+				if n == 0:
+					break
+				copied += n
+		except OSError:
+			# Not supported by that kernel or filesystem, try something else for the rest
+			pass
+
+	if src_fd is not None and copied < size and hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+		try:
+			os.lseek(dst_fd, dst_pos + copied, os.SEEK_SET)
+			while copied < size:
+				n = os.sendfile(dst_fd, src_fd, src_pos + copied, size - copied)
+				if n == 0:
+					break
+				copied += n
+		except OSError:
+			pass
 
-		sample_data = []
+	src_f.seek(src_pos + copied)
+	dst_f.seek(dst_pos + copied)
 
-		# Note: the file may be very big
-		i = 0
-		while i < ds:
-			d = f.read(ss)
-			if len(d) == 0:
-				break
-			sample_data.append(struct.unpack(sfc, d)[0])
-			i += 1
+	while copied < size:
+		data = src_f.read(min(COPY_BUFFER_SIZE, size - copied))
+		if len(data) == 0:
+			break
+		dst_f.write(data)
+		copied += len(data)
 
-	result['encoding'] = encoding
+	return copied
 
-	print('    ', result)
 
-	result['sample_data'] = sample_data
+# Size of the header WavWriter writes before samples
+WAV_HEADER_SIZE = 8 + 4 + (8 + DS64_CHUNK_SIZE) + (8 + 16) + 8
 
-	return result
+
+def get_wav_file_size(channels, bits_per_sample, numsamples):
+	# Size of a file WavWriter writes with that many samples
+	return WAV_HEADER_SIZE + numsamples * channels * bits_per_sample // 8
 
 
 class WavWriter:
-	def __init__(self, f, sample_rate, channels, bits_per_sample):
+	# If numsamples is given, the header is written right away for that many samples, and the file is never seeked,
+	# so it can go to a stream. Exactly that many samples must then be appended.
+
+	def __init__(self, f, sample_rate, channels, bits_per_sample, is_float=False, numsamples=None):
 		self.f = f
 		self.sample_rate = sample_rate
 		self.channels = channels
 		self.bits_per_sample = bits_per_sample
+		self.is_float = is_float
+		self.typecode = WAV_SAMPLE_TYPECODES[(bits_per_sample, is_float)]
 
 		self.finalized = False
 		self.samples_count = 0
 
 		self.fmt_chunk_size = 2 + 2 + 4 + 4 + 2 + 2
+		self.is_rf64 = False
+		self.numsamples = numsamples
+
+		if numsamples is not None:
+			self._write_header(numsamples)
+			return
 
 		self.initial_fpos = f.tell()
 
 		# Leave blank header size, we'll write it once all audio has been written.
-		# Go straight to the offset where we will write samples
-		riff_header_size = 8
-		riff_chunk_size_without_data = 4 + (8 + self.fmt_chunk_size) + 8 + 0
-		f.write(bytearray(riff_header_size + riff_chunk_size_without_data))
+		# Go straight to the offset where we will write samples.
+		# Room for a ds64 chunk is reserved with a "JUNK" chunk after "WAVE",
+		# so the file can become RF64 without moving the data if it gets too big.
+		f.write(bytearray(WAV_HEADER_SIZE))
 
 		self.data_fpos = f.tell()
 
 	def append_multichannel_samples(self, sample_data_per_channel):
+		# Takes one buffer of samples per channel, preferably `array`s of the writer's typecode.
+		# None can be given for channels that are silent.
 		assert not self.finalized
 		assert self.channels == len(sample_data_per_channel)
 
 		nchannels = self.channels
 
-		if nchannels == 1:
+		if nchannels == 1 and sample_data_per_channel[0] is not None:
 			# We can take a shortcut
-			interleaved_sample_data = sample_data_per_channel[0]
-			max_sample_count = len(interleaved_sample_data)
-
-		else:
-			# Get max channel length
-			max_sample_count = 0
-			for sample_data in sample_data_per_channel:
-				if len(sample_data) > max_sample_count:
-					if max_sample_count != 0:
-						# Ew, we had to adjust maximum twice
-						print("WARNING: appending multichannel sample data with different amount of samples!")
-					max_sample_count = len(sample_data)
-
-			# Make sure all channels have the same size
-			for sample_data in sample_data_per_channel:
-				if len(sample_data) > max_sample_count:
-					# Damn, where is resize(n)?
-					del sample_data[-(len(sample_data) - max_sample_count):]
-				else:
-					while len(sample_data) < max_sample_count:
-						sample_data.append(0)
+			self.append_interleaved_samples(sample_data_per_channel[0])
+			return
 
-			# Interleave
-			interleaved_sample_data = [0] * (max_sample_count * nchannels)
-			for channel, sample_data in enumerate(sample_data_per_channel):
-				i = channel
-				for v in sample_data:
-					interleaved_sample_data[i] = v
-					i += nchannels
+		# Get max channel length
+		lengths = [len(sample_data) for sample_data in sample_data_per_channel if sample_data is not None]
+		if len(lengths) == 0:
+			return
+		max_sample_count = max(lengths)
+		if min(lengths) != max_sample_count:
+			print("WARNING: appending multichannel sample data with different amount of samples!")
+
+		# Interleave with one strided slice assignment per channel.
+		# Shorter channels only fill the beginning of their slots,
+		# so the rest stays silent without copying or resizing anything.
+		typecode = self.typecode
+		interleaved_sample_data = array.array(typecode, bytes(max_sample_count * nchannels * array.array(typecode).itemsize))
+		for channel, sample_data in enumerate(sample_data_per_channel):
+			if sample_data is None:
+				continue
+			if not isinstance(sample_data, array.array) or sample_data.typecode != typecode:
+				sample_data = array.array(typecode, sample_data)
+			interleaved_sample_data[channel:len(sample_data) * nchannels:nchannels] = sample_data
 
 		self.append_interleaved_samples(interleaved_sample_data)
 
@@ -153,19 +604,80 @@ class WavWriter:
 
 		nsamples = len(sample_data) // self.channels
 		assert nsamples * self.channels == len(sample_data)
-		
-		sfc = 'h'
-		if self.bits_per_sample == 32:
-			sfc = 'i'
 
-		f = self.f
-		for v in sample_data:
-			f.write(struct.pack(sfc, v))
+		if not isinstance(sample_data, array.array) or sample_data.typecode != self.typecode:
+			sample_data = array.array(self.typecode, sample_data)
+
+		if sys.byteorder != 'little':
+			# WAV data is little-endian
+			sample_data = array.array(self.typecode, sample_data)
+			sample_data.byteswap()
+
+		if self.bits_per_sample == 24:
+			# Drop the most significant byte of each 32-bit integer
+			d = sample_data.tobytes()
+			packed = bytearray(len(sample_data) * 3)
+			packed[0::3] = d[0::4]
+			packed[1::3] = d[1::4]
+			packed[2::3] = d[2::4]
+			sample_data = packed
+
+		# Whole block in a single call
+		self.f.write(sample_data)
+
+		self.samples_count += nsamples
+
+	def append_raw_data_from_file(self, src_f, size):
+		# Copies up to `size` bytes of sample data that are already encoded like this WAV file,
+		# from the current position of another file. Returns how many samples were copied.
+		assert not self.finalized
+
+		frame_size = self.channels * self.bits_per_sample // 8
+		size -= size % frame_size
+
+		copied = copy_file_data(src_f, self.f, size)
+
+		partial = copied % frame_size
+		if partial != 0:
+			# Source ended in the middle of a sample, complete it so the next ones stay aligned
+			self.f.write(bytes(frame_size - partial))
+			copied += frame_size - partial
+
+		nsamples = copied // frame_size
+		self.samples_count += nsamples
+		return nsamples
+
+	def append_silence(self, nsamples, sparse=False):
+		# If sparse is True, the file gets extended without writing anything,
+		# which leaves a hole that file systems supporting it don't store.
+		assert not self.finalized
+
+		frame_size = self.channels * self.bits_per_sample // 8
+
+		if sparse:
+			# Reads as zeros. Truncating makes sure the file grows even if nothing gets written after.
+			self.f.seek(nsamples * frame_size, os.SEEK_CUR)
+			self.f.truncate()
+		else:
+			# Zeros are silence in all formats we support.
+			# Write them in pieces, the gap could be very long.
+			remaining = nsamples
+			while remaining > 0:
+				count = min(remaining, 65536)
+				self.f.write(bytes(count * frame_size))
+				remaining -= count
 
 		self.samples_count += nsamples
 
 	def finalize(self):
 		assert not self.finalized
+
+		if self.numsamples is not None:
+			# Header was written already
+			assert self.samples_count == self.numsamples
+			self.finalized = True
+			return
+
 		f = self.f
 
 		end = f.tell()
@@ -173,16 +685,35 @@ class WavWriter:
 		f.seek(self.initial_fpos)
 
 		assert data_chunk_size == (self.samples_count * self.channels * self.bits_per_sample // 8)
-		# "WAVE" letters + two FourCC+size headers and their chunk size.
+		self._write_header(self.samples_count)
+
+		self.finalized = True
+
+	def _write_header(self, samples_count):
+		f = self.f
+		data_chunk_size = samples_count * self.channels * self.bits_per_sample // 8
+
+		# "WAVE" letters + three FourCC+size headers and their chunk size.
 		# Does not include the size of the top-level header "RIFF"+size.
-		riff_chunk_size = 4 + (8 + self.fmt_chunk_size) + (8 + data_chunk_size)
+		riff_chunk_size = 4 + (8 + DS64_CHUNK_SIZE) + (8 + self.fmt_chunk_size) + (8 + data_chunk_size)
 
-		f.write(b'RIFF')
-		f.write(struct.pack('I', riff_chunk_size))
+		self.is_rf64 = riff_chunk_size > RIFF_MAX_CHUNK_SIZE
 
-		f.write(b'WAVE')
-		#wave_chunk_size = ???
-		#f.write(struct.pack('I', wave_chunk_size))
+		if self.is_rf64:
+			f.write(b'RF64')
+			f.write(struct.pack('<I', RIFF_MAX_CHUNK_SIZE))
+			f.write(b'WAVE')
+			f.write(b'ds64')
+			f.write(struct.pack('<I', DS64_CHUNK_SIZE))
+			f.write(struct.pack('<QQQI', riff_chunk_size, data_chunk_size, samples_count, 0))
+		else:
+			f.write(b'RIFF')
+			f.write(struct.pack('I', riff_chunk_size))
+			f.write(b'WAVE')
+			# Readers skip chunks they don't know
+			f.write(b'JUNK')
+			f.write(struct.pack('I', DS64_CHUNK_SIZE))
+			f.write(bytes(DS64_CHUNK_SIZE))
 
 		# ----------
 		f.write(b'fmt ')
@@ -190,7 +721,8 @@ class WavWriter:
 
 		# Format
 		# PCM = 1 (i.e. Linear quantization) Values other than 1 indicate some form of compression.
-		f.write(struct.pack('H', 1))
+		# IEEE float = 3
+		f.write(struct.pack('H', WAVE_FORMAT_IEEE_FLOAT if self.is_float else WAVE_FORMAT_PCM))
 
 		f.write(struct.pack('H', self.channels))
 
@@ -208,10 +740,12 @@ class WavWriter:
 		f.write(struct.pack('H', self.bits_per_sample))
 
 		f.write(b'data')
-		f.write(struct.pack('I', data_chunk_size))
-		# And what follows is what we wrote before
-
-		self.finalized = True
+		if self.is_rf64:
+			# The actual size is in ds64
+			f.write(struct.pack('<I', RIFF_MAX_CHUNK_SIZE))
+		else:
+			f.write(struct.pack('I', data_chunk_size))
+		# And what follows is the samples
 
 
 # Legacy shortcut
@@ -222,220 +756,2026 @@ class WavWriter:
 # 		w.finalize()
 
 
-def convert_au_files_to_wav(src_paths_by_channel, dst_path):
-	if len(src_paths_by_channel) == 0:
-		return
-	
-	# Eliminate channels with no blocks
-	temp = []
-	for c in src_paths_by_channel:
-		if len(c) != 0:
-			temp.append(c)
-	src_paths_by_channel = temp
-
-	print("Converting blocks ", src_paths_by_channel)
-	# Concatenate a bunch of .au block files into a single WAV file
-	with open(dst_path, 'wb') as f:
-		w = None
-
-		nchannels = len(src_paths_by_channel)
-
-		# For each block
-		for block_index in range(len(src_paths_by_channel[0])):
-			samples_by_channel = []
-
-			# Process each corrsponding channel for that block
-			for channel in range(nchannels):
-				src_paths = src_paths_by_channel[channel]
-
-				if block_index >= len(src_paths):
-					# That block doesn't have data on each channel...
-					samples_by_channel.append([])
-					continue
-
-				au = load_au_file(src_paths[block_index])
-				samples = au['sample_data']
-
-				if au['channels'] != 1:
-					# TODO Deal with this eventually...
-					# As far as I've seen, Audacity actually saves stereo blocks as separate mono .au files. WHY??
-					print("ERROR: I didn't expect .au files to have 2 channels "
-						  "(at least my experience so far has shown they were always mono)")
-					return 0
-
-				# Make sure it ends up in the encoding we want
-				if au['encoding'] == AU_SAMPLE_FORMAT_FLOAT:
-					for i, v in enumerate(samples):
-						# We want 16-bit PCM
-						samples[i] = int(v * 32767.0)
-				elif au['encoding'] == AU_SAMPLE_FORMAT_24:
-					print("ERROR: 24 bits not supported")
-					return
-				elif au['encoding'] == AU_SAMPLE_FORMAT_16:
-					pass # Already OK
-				else:
-					print("ERROR: Unknown .au encoding: ", au['encoding'])
-					return 0
+# Sample formats we can output.
+# Values are (bits per sample, whether samples are float, typecode of the `array`s holding them).
+OUTPUT_FORMATS = {
+	'int16': (16, False, 'h'),
+	'int24': (24, False, 'i'),
+	'float32': (32, True, 'f')
+}
+
+# Which output format matches each .au encoding without conversion
+AU_ENCODING_OUTPUT_FORMATS = {
+	AU_SAMPLE_FORMAT_16: 'int16',
+	AU_SAMPLE_FORMAT_24: 'int24',
+	AU_SAMPLE_FORMAT_FLOAT: 'float32'
+}
+
+# Which output format matches each `sampleformat` found in Audacity sequences
+AUDACITY_SAMPLE_FORMAT_OUTPUT_FORMATS = {
+	0x00020001: 'int16',
+	0x00040001: 'int24',
+	0x0004000F: 'float32'
+}
+
+# Integer formats map [-1, 1[ to [-scale, scale[
+_INTEGER_FORMAT_SCALES = {
+	'int16': 32768.0,
+	'int24': 8388608.0
+}
+
+
+def get_output_format_name(writer):
+	# Returns which of OUTPUT_FORMATS a WavWriter writes
+	for name, (bits_per_sample, is_float, typecode) in OUTPUT_FORMATS.items():
+		if bits_per_sample == writer.bits_per_sample and is_float == writer.is_float:
+			return name
+	return None
+
+
+def convert_samples(samples, src_format, dst_format, dither=False):
+	# Converts an `array` of samples from one output format to another in one vectorized step,
+	# with rounding and clipping. If dither is True, triangular noise of one step is added
+	# before quantizing to an integer format, when that actually loses resolution.
+	# NaN and infinite float samples become silence. Returns samples as-is if formats are the same.
+
+	if src_format == dst_format:
+		return samples
+
+	dst_typecode = OUTPUT_FORMATS[dst_format][2]
+	src_scale = _INTEGER_FORMAT_SCALES.get(src_format, 1.0)
+	dst_scale = _INTEGER_FORMAT_SCALES.get(dst_format)
+
+	if dst_scale is None:
+		# To float, nothing can go out of range
+		k = 1.0 / src_scale
+		if numpy is not None:
+			x = numpy.frombuffer(samples, dtype=samples.typecode).astype(numpy.float32)
+			x *= k
+			return array.array(dst_typecode, x.tobytes())
+		return array.array(dst_typecode, [v * k for v in samples])
+
+	k = dst_scale / src_scale
+	lo = -dst_scale
+	hi = dst_scale - 1.0
+
+	# Widening an integer format is exact, noise would only corrupt it
+	from_float = src_format not in _INTEGER_FORMAT_SCALES
+	dither = dither and (from_float or k < 1.0)
+
+	if numpy is not None:
+		x = numpy.frombuffer(samples, dtype=samples.typecode).astype(numpy.float64)
+		if from_float:
+			x[~numpy.isfinite(x)] = 0.0
+		x *= k
+		if dither:
+			rng = numpy.random.default_rng()
+			x += rng.random(len(x))
+			x -= rng.random(len(x))
+		x += 0.5
+		numpy.floor(x, out=x)
+		numpy.clip(x, lo, hi, out=x)
+		return array.array(dst_typecode, x.astype(dst_typecode).tobytes())
+
+	floor = math.floor
+	ilo = int(lo)
+	ihi = int(hi)
+	if from_float:
+		isfinite = math.isfinite
+		samples = [v if isfinite(v) else 0.0 for v in samples]
+	if dither:
+		rand = random.random
+		return array.array(dst_typecode, [min(ihi, max(ilo, floor(v * k + rand() - rand() + 0.5))) for v in samples])
+	return array.array(dst_typecode, [min(ihi, max(ilo, floor(v * k + 0.5))) for v in samples])
+
+
+# Default upper bound for the memory holding samples while converting a clip
+DEFAULT_MAX_BUFFER_SIZE = 64 * 1024 * 1024
+
+# Rough amount of memory each sample of a chunk costs while it goes through conversion:
+# raw bytes, decoded array, intermediate 64-bit floats and dither noise, converted array
+# and its slot in the interleaved array.
+BUFFERED_BYTES_PER_SAMPLE = 40
+
+# Chunks smaller than this would make us spend more time in Python than in I/O
+MIN_CHUNK_SAMPLES = 4096
+
+
+REAPEAKS_EXTENSION = '.reapeaks'
+
+# Peaks per second in the most detailed level of .reapeaks files,
+# and how many peaks of each level are summarized by one of the next level
+REAPEAKS_PEAK_RATE = 400
+REAPEAKS_MIPMAP_FACTORS = (40, 10)
+
+# Full scale of peaks in each output format
+_PEAK_FORMAT_SCALES = {
+	'int16': 32767.0 / 32767.0,
+	'int24': 32767.0 / 8388607.0,
+	'float32': 32767.0
+}
+
+
+class PeakBuilder:
+	# Computes the peaks Reaper displays for a WAV file while its samples get written,
+	# and saves them as a .reapeaks file next to it, so Reaper doesn't have to build them when opening the project.
+	# See reapeaks.txt in the Reaper SDK. Peaks are 16-bit maximums and minimums of each channel
+	# over windows of `division` samples, with a few levels of detail.
+	# Reaper checks the modification time and size of the WAV file they were made for,
+	# and builds peaks itself if they don't match.
+
+	def __init__(self, channels, sample_rate, output_format):
+		self.channels = channels
+		self.sample_rate = sample_rate
+		self.division = max(1, sample_rate // REAPEAKS_PEAK_RATE)
+		self.scale = _PEAK_FORMAT_SCALES[output_format]
+		self.typecode = OUTPUT_FORMATS[output_format][2]
+		self.maxs = [array.array('h') for i in range(channels)]
+		self.mins = [array.array('h') for i in range(channels)]
+		# Samples that don't make a whole window yet
+		self._pending = [array.array(self.typecode) for i in range(channels)]
+
+	def _to_peak(self, v):
+		return max(-32767, min(32767, int(math.floor(v * self.scale + 0.5))))
+
+	def add_samples(self, samples_by_channel, nsamples):
+		# Takes the same arguments as WavWriter.append_multichannel_samples, and how many samples they make
+		division = self.division
+		to_peak = self._to_peak
+
+		for channel in range(self.channels):
+			samples = samples_by_channel[channel]
+			pending = self._pending[channel]
+
+			if samples is None:
+				pending.extend(array.array(self.typecode, bytes(nsamples * pending.itemsize)))
+			else:
+				pending.extend(samples[:nsamples])
+				if len(samples) < nsamples:
+					pending.extend(array.array(self.typecode, bytes((nsamples - len(samples)) * pending.itemsize)))
+
+			count = len(pending) // division * division
+			if count == 0:
+				continue
 
-				if w is None:
-					w = WavWriter(f, au['sample_rate'], nchannels, 16)
+			if numpy is not None:
+				# View a copy, pending can't be resized while NumPy holds its buffer
+				windows = numpy.frombuffer(pending[:count], dtype=pending.typecode).reshape(-1, division)
+				# Scale in double precision like _to_peak, float32 would round some peaks differently
+				peaks = numpy.clip(numpy.floor(windows.max(axis=1).astype(numpy.float64) * self.scale + 0.5), -32767, 32767)
+				self.maxs[channel].extend(peaks.astype(numpy.int16).tolist())
+				peaks = numpy.clip(numpy.floor(windows.min(axis=1).astype(numpy.float64) * self.scale + 0.5), -32767, 32767)
+				self.mins[channel].extend(peaks.astype(numpy.int16).tolist())
+			else:
+				self.maxs[channel].extend([to_peak(max(pending[i:i + division])) for i in range(0, count, division)])
+				self.mins[channel].extend([to_peak(min(pending[i:i + division])) for i in range(0, count, division)])
+
+			del pending[:count]
+
+	def add_silence(self, nsamples):
+		self.add_samples([None] * self.channels, nsamples)
+
+	def _get_mipmaps(self):
+		# Returns (division, maximums by channel, minimums by channel) for each level of detail
+		maxs = [array.array('h', m) for m in self.maxs]
+		mins = [array.array('h', m) for m in self.mins]
+
+		# Last partial window
+		for channel, pending in enumerate(self._pending):
+			if len(pending) != 0:
+				maxs[channel].append(self._to_peak(max(pending)))
+				mins[channel].append(self._to_peak(min(pending)))
+
+		mipmaps = [(self.division, maxs, mins)]
+
+		for factor in REAPEAKS_MIPMAP_FACTORS:
+			division, maxs, mins = mipmaps[-1]
+			count = len(maxs[0])
+			mipmaps.append((division * factor,
+				[array.array('h', [max(m[i:i + factor]) for i in range(0, count, factor)]) for m in maxs],
+				[array.array('h', [min(m[i:i + factor]) for i in range(0, count, factor)]) for m in mins]))
+
+		return mipmaps
+
+	def save(self, fpath, wav_path):
+		mipmaps = self._get_mipmaps()
+		nchannels = self.channels
 
-				elif w.sample_rate != au['sample_rate']:
-					print("ERROR: sample rate differs in one of the .au files I wanted to concatenate into one .wav")
-					# TODO Resample, or return multiple files and split the clip...
+		with open(fpath, 'wb') as f:
+			f.write(b'RPKM')
+			f.write(struct.pack('<BBi', nchannels, len(mipmaps), self.sample_rate))
+			f.write(_get_reapeaks_source_info(wav_path))
+
+			for division, maxs, mins in mipmaps:
+				f.write(struct.pack('<ii', division, len(maxs[0])))
+
+			for division, maxs, mins in mipmaps:
+				# For each peak, maximums of all channels followed by their minimums
+				count = len(maxs[0])
+				data = array.array('h', bytes(count * nchannels * 2 * 2))
+				for channel in range(nchannels):
+					data[channel::nchannels * 2] = maxs[channel]
+					data[nchannels + channel::nchannels * 2] = mins[channel]
+				if sys.byteorder != 'little':
+					data.byteswap()
+				f.write(data)
+
+
+# Where the modification time and size of the WAV file are in .reapeaks files
+_REAPEAKS_SOURCE_INFO_OFFSET = 10
+
+
+def _get_reapeaks_source_info(wav_path):
+	st = os.stat(wav_path)
+	return struct.pack('<II', int(st.st_mtime) & 0xffffffff, st.st_size & 0xffffffff)
+
+
+def update_reapeaks_source_info(fpath, wav_path):
+	# Makes a .reapeaks file match a WAV file it was not built next to, such as one copied from a cache
+	with open(fpath, 'r+b') as f:
+		f.seek(_REAPEAKS_SOURCE_INFO_OFFSET)
+		f.write(_get_reapeaks_source_info(wav_path))
+
+
+def read_file_data(fpath):
+	with open(fpath, 'rb') as f:
+		return f.read()
+
+
+class BlockPrefetcher:
+	# Reads blocks ahead of when they are needed on a pool of threads,
+	# so waiting on storage overlaps with converting and writing previous blocks.
+	# Files must be requested in the order they were given, though some can be skipped.
+	# At most `depth` files are held in memory at once, and if max_size is given,
+	# no more than that many bytes unless a single file is bigger.
+
+	def __init__(self, executor, fpaths, depth, max_size=None):
+		self._executor = executor
+		self._fpaths = iter(fpaths)
+		self._depth = depth
+		self._max_size = max_size
+		# (path, size) of the next file to read, once we know its size
+		self._next = None
+		# (path, size, future) of files being read or waiting to be requested
+		self._pending = collections.deque()
+		self._pending_size = 0
+		self._fill()
+
+	def _fill(self):
+		while len(self._pending) < self._depth:
+			if self._next is None:
+				fpath = next(self._fpaths, None)
+				if fpath is None:
 					break
+				self._next = (fpath, 0 if self._max_size is None else get_block_size(fpath))
 
-				samples_by_channel.append(samples)
-
-			w.append_multichannel_samples(samples_by_channel)
-
-		w.finalize()
-
-	return 0 if w is None else w.samples_count
-
+			fpath, size = self._next
+			if len(self._pending) != 0 and self._max_size is not None and self._pending_size + size > self._max_size:
+				break
 
-def load_audacity_project(fpath):
-	root = ET.parse(fpath).getroot()
+			self._next = None
+			self._pending.append((fpath, size, self._executor.submit(read_block_data, fpath)))
+			self._pending_size += size
+
+	def get(self, fpath):
+		# Returns the content of the file
+		while len(self._pending) != 0:
+			pending_fpath, size, future = self._pending.popleft()
+			self._pending_size -= size
+			self._fill()
+			if pending_fpath == fpath:
+				return future.result()
+		# Wasn't expected, read it now
+		return read_block_data(fpath)
+
+
+class SerialCallThread:
+	# Runs functions on a thread in the order they were given, with at most `depth` of them waiting.
+	# The first exception they raise is raised again by the next call() or close().
+
+	def __init__(self, depth):
+		self._queue = queue.Queue(depth)
+		self._error = None
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def _run(self):
+		while True:
+			item = self._queue.get()
+			if item is None:
+				break
+			if self._error is None:
+				try:
+					item[0](*item[1])
+				except BaseException as e:
+					self._error = e
+
+	def call(self, func, *args):
+		if self._error is not None:
+			raise self._error
+		self._queue.put((func, args))
+
+	def close(self):
+		if self._thread is None:
+			return
+		self._queue.put(None)
+		self._thread.join()
+		self._thread = None
+		if self._error is not None:
+			raise self._error
+
+
+def convert_au_files_to_wav(src_paths_by_channel, dst_path, max_buffer_size=DEFAULT_MAX_BUFFER_SIZE,
+	output_format=None, dither=False):
+	# Concatenates a bunch of .au block files into a single WAV file.
+	# src_paths_by_channel has a list of block files for each channel. Entries may be None for silent blocks.
+	# Returns how many samples were written, or None if the blocks could not be converted.
+	# output_format is one of OUTPUT_FORMATS. If None, the format of the first block is kept.
+	counts = convert_au_segments_to_wav([(src_paths_by_channel, None)], dst_path, max_buffer_size, output_format, dither)
+	return None if counts is None else counts[0]
+
+
+def get_segments_channel_count(segments):
+	# Returns how many channels a file made of these segments has, see convert_au_segments_to_wav,
+	# and whether it has any block to read.
+	# Trailing channels with no blocks are left out.
+	# Channels with only silent blocks are kept, they are silent but still there.
+	nchannels = 0
+	has_blocks = False
+	for src_paths_by_channel, numsamples in segments:
+		for channel, src_paths in enumerate(src_paths_by_channel):
+			if channel >= nchannels and len(src_paths) != 0:
+				nchannels = channel + 1
+			if not has_blocks and any(p is not None for p in src_paths):
+				has_blocks = True
+	return nchannels, has_blocks
+
+
+def convert_au_segments_to_wav(segments, dst_path, max_buffer_size=DEFAULT_MAX_BUFFER_SIZE,
+	output_format=None, dither=False, stats=None, read_ahead=0, peaks_path=None, sparse_silence=False,
+	dst_f=None):
+	# Concatenates segments into a single WAV file, each made of a bunch of .au block files.
+	# Segments are (src_paths_by_channel, numsamples) tuples, see convert_au_files_to_wav.
+	# If numsamples is not None, the segment gets padded with silence or truncated so that
+	# it takes exactly that many samples in the file, which keeps offsets of the next segments predictable.
+	# Time spent reading, converting and writing samples goes into stats, if given (see ConversionStats).
+	# If read_ahead is more than 0, up to that many block files are read ahead on as many threads,
+	# and writing happens on another thread, which hides latency of slow storage.
+	# All of it stays within max_buffer_size.
+	# If peaks_path is given, Reaper peaks are computed along the way and saved there (see PeakBuilder).
+	# Segments without blocks are silent gaps. If sparse_silence is True, they are left as holes in the file.
+	# If dst_f is given, the file is written there instead of dst_path, from start to end without seeking.
+	# Every segment must then have its numsamples.
+	# Returns how many samples were found in each segment, or None if the blocks could not be converted.
+
+	if stats is None:
+		stats = ConversionStats()
+
+	nchannels, has_blocks = get_segments_channel_count(segments)
+
+	if not has_blocks:
+		return None
+
+	total_numsamples = None
+	if dst_f is not None:
+		total_numsamples = sum(numsamples for src_paths_by_channel, numsamples in segments)
+
+	prepare_sqlite_blocks([src_path for src_paths_by_channel, numsamples in segments
+		for src_paths in src_paths_by_channel for src_path in src_paths if src_path is not None])
+
+	# Samples are streamed through fixed-size chunks, so memory doesn't depend on block size.
+	# When reading ahead, half of the memory goes to blocks read ahead, and the other half is shared by
+	# the chunk being converted, those waiting for the writer thread and the one it is writing.
+	chunk_buffer_size = max_buffer_size
+	chunks_in_flight = 1
+	if read_ahead > 0:
+		chunk_buffer_size = max_buffer_size // 2
+		chunks_in_flight = read_ahead + 2
+	chunk_samples = max(MIN_CHUNK_SAMPLES,
+		chunk_buffer_size // (chunks_in_flight * nchannels * BUFFERED_BYTES_PER_SAMPLE))
+
+	counts = []
+
+	def write(func, *args):
+		with stats.measure('wav_write'):
+			func(*args)
+
+	peaks = None
+
+	with contextlib.ExitStack() as pipeline_stack:
+		if dst_f is not None:
+			f = dst_f
+		else:
+			f = pipeline_stack.enter_context(open(dst_path, 'wb'))
+		w = None
+		prefetcher = None
+		writer_thread = None
+
+		if read_ahead > 0:
+			# Blocks in the order they will be needed
+			fpaths = []
+			for src_paths_by_channel, numsamples in segments:
+				src_paths_by_channel = src_paths_by_channel[:nchannels]
+				for block_index in range(max([len(src_paths) for src_paths in src_paths_by_channel] + [0])):
+					for src_paths in src_paths_by_channel:
+						if block_index < len(src_paths) and src_paths[block_index] is not None:
+							fpaths.append(src_paths[block_index])
+
+			executor = pipeline_stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=read_ahead))
+			prefetcher = BlockPrefetcher(executor, fpaths, read_ahead, max_buffer_size - chunk_buffer_size)
+			writer_thread = SerialCallThread(read_ahead)
+			# Runs before the file gets closed
+			pipeline_stack.callback(writer_thread.close)
+
+		for src_paths_by_channel, expected_numsamples in segments:
+			src_paths_by_channel = src_paths_by_channel[:nchannels]
+
+			print("Converting blocks ", src_paths_by_channel)
+
+			segment_block_count = max([len(src_paths) for src_paths in src_paths_by_channel] + [0])
+			found_numsamples = 0
+
+			if segment_block_count == 0 and expected_numsamples is not None:
+				# Silent gap, nothing to find
+				found_numsamples = expected_numsamples
+			written_numsamples = 0
+
+			# For each block
+			for block_index in range(segment_block_count):
+
+				with contextlib.ExitStack() as stack:
+					readers = []
+					skip_block = False
+
+					# Open each corrsponding channel for that block
+					for channel in range(nchannels):
+						src_paths = src_paths_by_channel[channel] if channel < len(src_paths_by_channel) else []
+
+						if block_index >= len(src_paths) or src_paths[block_index] is None:
+							# That block doesn't have data on each channel...
+							readers.append(None)
+							continue
+
+						with stats.measure('au_read'):
+							if prefetcher is not None:
+								au = open_block(src_paths[block_index], prefetcher.get(src_paths[block_index]))
+							else:
+								au = open_block(src_paths[block_index])
+						if au is None:
+							return None
+						stack.enter_context(au)
+						stats.blocks += 1
+
+						if au.channels != 1:
+							# TODO Deal with this eventually...
+							# As far as I've seen, Audacity actually saves stereo blocks as separate mono .au files. WHY??
+							print("ERROR: I didn't expect .au files to have 2 channels "
+								  "(at least my experience so far has shown they were always mono)")
+							return None
+
+						if w is None:
+							if output_format is None:
+								output_format = AU_ENCODING_OUTPUT_FORMATS[au.encoding]
+							bits_per_sample, is_float, typecode = OUTPUT_FORMATS[output_format]
+							w = WavWriter(f, au.sample_rate, nchannels, bits_per_sample, is_float, total_numsamples)
+							if peaks_path is not None:
+								peaks = PeakBuilder(nchannels, au.sample_rate, output_format)
+
+						elif w.sample_rate != au.sample_rate:
+							print("ERROR: sample rate differs in one of the .au files I wanted to concatenate into one .wav")
+							# TODO Resample, or return multiple files and split the clip...
+							skip_block = True
+							break
+
+						readers.append(au)
+
+					if skip_block:
+						continue
+
+					if nchannels == 1 and readers[0] is not None and prefetcher is None and peaks is None \
+						and readers[0].can_copy_data_to(w):
+						# Samples are already encoded as they should be in the file,
+						# copy them as they are, without having them go through Python
+						au = readers[0]
+						available = au.get_remaining_samples()
+						found_numsamples += available
+
+						count = available
+						if expected_numsamples is not None:
+							count = max(0, min(count, expected_numsamples - written_numsamples))
+
+						with stats.measure('splice'):
+							written_numsamples += au.copy_data_to(w, count)
+						continue
+
+					# Move the block through in chunks
+					while True:
+						samples_by_channel = []
+						chunk_numsamples = 0
+
+						for au in readers:
+							if au is None:
+								samples_by_channel.append(None)
+								continue
+
+							with stats.measure('au_read'):
+								samples = au.read(chunk_samples)
+							chunk_numsamples = max(chunk_numsamples, len(samples))
+
+							# Make sure it ends up in the encoding we want
+							with stats.measure('sample_conversion'):
+								samples = convert_samples(samples, AU_ENCODING_OUTPUT_FORMATS[au.encoding],
+									output_format, dither)
+
+							samples_by_channel.append(samples)
+
+						if chunk_numsamples == 0:
+							break
+
+						found_numsamples += chunk_numsamples
+
+						if expected_numsamples is not None:
+							remaining = expected_numsamples - written_numsamples
+							if remaining <= 0:
+								continue
+							if chunk_numsamples > remaining:
+								samples_by_channel = [None if samples is None else samples[:remaining]
+									for samples in samples_by_channel]
+								chunk_numsamples = remaining
+
+						if writer_thread is not None:
+							writer_thread.call(write, w.append_multichannel_samples, samples_by_channel)
+						else:
+							write(w.append_multichannel_samples, samples_by_channel)
+						written_numsamples += chunk_numsamples
 
-	rate = int(float(root.attrib["rate"]))
-	name = root.attrib['projname']
+						if peaks is not None:
+							with stats.measure('peaks'):
+								peaks.add_samples(samples_by_channel, chunk_numsamples)
 
-	ns = { 'ns': 'http://audacity.sourceforge.net/xml/' }
+			if expected_numsamples is not None and written_numsamples < expected_numsamples and w is not None:
+				if writer_thread is not None:
+					writer_thread.call(write, w.append_silence, expected_numsamples - written_numsamples, sparse_silence)
+				else:
+					write(w.append_silence, expected_numsamples - written_numsamples, sparse_silence)
+				if peaks is not None:
+					peaks.add_silence(expected_numsamples - written_numsamples)
+
+			counts.append(found_numsamples)
+
+		if w is not None:
+			if writer_thread is not None:
+				writer_thread.call(write, w.finalize)
+				writer_thread.close()
+			else:
+				write(w.finalize)
+
+	if peaks is not None:
+		# Now that the file is closed, its size and modification time are final
+		with stats.measure('peaks'):
+			peaks.save(peaks_path, dst_path)
+
+	return counts
+
+
+BLOCK_SIMPLE = 0
+BLOCK_PCMALIAS = 1
+BLOCK_SILENT = 2
+
+# Names of block types, as found in .aup files
+BLOCK_TYPE_NAMES = {
+	BLOCK_SIMPLE: 'simpleblockfile',
+	BLOCK_PCMALIAS: 'pcmaliasblockfile',
+	BLOCK_SILENT: 'silentblockfile'
+}
+
+
+class Project:
+	__slots__ = ('rate', 'name', 'data_dir', 'db_path', 'tracks', 'converted_tracks')
+
+	def __init__(self, rate, name, data_dir, db_path=None):
+		self.rate = rate
+		self.name = name
+		self.data_dir = data_dir
+		# Database holding the blocks of Audacity 3 projects, None for older ones which have data_dir instead
+		self.db_path = db_path
+		self.tracks = []
+		# Filled by the conversion, see ConvertedTrack
+		self.converted_tracks = []
+
+
+class Track:
+	__slots__ = ('name', 'channel', 'linked', 'mute', 'solo', 'rate', 'gain', 'pan', 'color_index', 'clips')
+
+	def __init__(self):
+		self.name = ""
+		self.channel = 0
+		self.linked = False
+		self.mute = False
+		self.solo = False
+		self.rate = 44100
+		self.gain = 1.0
+		self.pan = 0.0
+		self.color_index = 0
+		self.clips = []
+
+
+class Clip:
+	__slots__ = ('offset', 'color_index', 'sequence', 'envelope', 'trim_left', 'trim_right')
+
+	def __init__(self, offset, color_index):
+		# In seconds
+		self.offset = offset
+		self.color_index = color_index
+		self.sequence = None
+		# List of EnvelopePoint
+		self.envelope = []
+		# Since Audacity 3.1, clips can hide samples at their beginning and end. In seconds.
+		self.trim_left = 0.0
+		self.trim_right = 0.0
+
+
+class EnvelopePoint:
+	__slots__ = ('t', 'val')
+
+	def __init__(self, t, val):
+		self.t = t
+		self.val = val
+
+
+class Block:
+	# View of one block of a Sequence, which doesn't store them as objects
+	__slots__ = ('type', 'start', 'len', 'filename', 'min', 'max', 'rms', 'file_start', 'summary_file', 'channel')
+
+
+class Sequence:
+	# Projects can have hundreds of thousands of blocks, so they are stored column-wise in typed arrays.
+	# Use get_block() or iteration to get them as Block objects,
+	# or access columns directly where it matters.
+
+	__slots__ = (
+		'max_samples', 'sample_format', 'numsamples',
+		'block_types', 'block_starts', 'block_lens', 'block_mins', 'block_maxs', 'block_rmss', 'block_filenames',
+		# Only meaningful for pcmalias blocks
+		'block_file_starts', 'block_channels', 'block_summary_files'
+	)
+
+	def __init__(self, max_samples, sample_format, numsamples):
+		self.max_samples = max_samples
+		self.sample_format = sample_format
+		self.numsamples = numsamples
+
+		self.block_types = array.array('B')
+		self.block_starts = array.array('q')
+		self.block_lens = array.array('q')
+		self.block_mins = array.array('f')
+		self.block_maxs = array.array('f')
+		self.block_rmss = array.array('f')
+		# Interned, because blocks aliasing the same file all repeat its name
+		self.block_filenames = []
+
+		self.block_file_starts = array.array('q')
+		self.block_channels = array.array('b')
+		self.block_summary_files = []
+
+	def append_block(self, btype, start, length, filename=None, bmin=0.0, bmax=0.0, rms=0.0,
+		file_start=0, channel=0, summary_file=None):
+
+		self.block_types.append(btype)
+		self.block_starts.append(start)
+		self.block_lens.append(length)
+		self.block_mins.append(bmin)
+		self.block_maxs.append(bmax)
+		self.block_rmss.append(rms)
+		self.block_filenames.append(None if filename is None else sys.intern(filename))
+		self.block_file_starts.append(file_start)
+		self.block_channels.append(channel)
+		self.block_summary_files.append(summary_file)
+
+	def get_block_count(self):
+		return len(self.block_types)
+
+	def get_block(self, i):
+		b = Block()
+		b.type = self.block_types[i]
+		b.start = self.block_starts[i]
+		b.len = self.block_lens[i]
+		b.filename = self.block_filenames[i]
+		b.min = self.block_mins[i]
+		b.max = self.block_maxs[i]
+		b.rms = self.block_rmss[i]
+		b.file_start = self.block_file_starts[i]
+		b.channel = self.block_channels[i]
+		b.summary_file = self.block_summary_files[i]
+		return b
+
+	def __iter__(self):
+		for i in range(len(self.block_types)):
+			yield self.get_block(i)
+
+
+class ConvertedTrack:
+	# Track as it will end up in the Reaper project
+	__slots__ = ('name', 'mute', 'solo', 'rate', 'gain', 'pan', 'color_index', 'envelope', 'clips')
+
+	def __init__(self, track):
+		self.name = track.name
+		self.mute = track.mute
+		self.solo = track.solo
+		self.rate = track.rate
+		self.gain = track.gain
+		self.pan = track.pan
+		self.color_index = track.color_index
+		# List of EnvelopePoint sorted by time, None if the track has no envelope
+		self.envelope = None
+		# List of ConvertedClip
+		self.clips = []
+
+
+class ConvertedClip:
+	__slots__ = ('offset', 'numsamples', 'filename', 'file_start', 'is_section')
+
+	def __init__(self, offset, numsamples, filename, file_start=None, is_section=False):
+		# In seconds
+		self.offset = offset
+		self.numsamples = numsamples
+		self.filename = filename
+		# Where the clip starts in the file, in samples. None if it starts at the beginning.
+		self.file_start = file_start
+		# If True, the clip is a section of a file holding other clips too
+		self.is_section = is_section
+
+
+class AudacityProjectBuilder:
+	# Builds a Project from XML elements as they get parsed,
+	# so we never need the whole document in memory.
+	# Elements are identified by their depth, which also leaves out nested ones we don't handle, like cutlines.
+
+	def __init__(self, data_dir, db_path=None):
+		self.project = None
+		self.data_dir = data_dir
+		self.db_path = db_path
+		self.depth = 0
+
+		self._track = None
+		self._clip = None
+		self._sequence = None
+		self._waveblock_start = 0
+		self._in_envelope = False
+
+	@staticmethod
+	def _unescape(s):
+		return html.unescape(s)
 
+	def start(self, tag, attrib):
+		self.depth += 1
+		depth = self.depth
+		unescape = self._unescape
+
+		if depth == 1:
+			if tag == 'project':
+				# Audacity 3 projects don't have a name, they are just the file
+				name = attrib.get('projname')
+				if name is None:
+					name = os.path.splitext(os.path.basename(self.db_path or ''))[0]
+				self.project = Project(int(float(attrib["rate"])), unescape(name), self.data_dir, self.db_path)
+
+		elif depth == 2:
+			if tag == 'wavetrack':
+				track = Track()
+				track.name = unescape(attrib['name'])
+				track.channel = int(attrib['channel'])
+				# Audacity 3.1 has more kinds of linking than 1
+				track.linked = attrib['linked'] != '0'
+				track.mute = attrib['mute'] == '1'
+				track.solo = attrib['solo'] == '1'
+				track.rate = int(attrib['rate'])
+				track.gain = float(attrib['gain'])
+				track.pan = float(attrib['pan'])
+				track.color_index = int(attrib['colorindex'])
+				self.project.tracks.append(track)
+				self._track = track
+
+		elif self._track is None:
+			pass
+
+		elif depth == 3:
+			if tag == 'waveclip':
+				self._clip = Clip(float(attrib['offset']), int(attrib.get('colorindex', '0')))
+				self._clip.trim_left = float(attrib.get('trimLeft', 0.0))
+				self._clip.trim_right = float(attrib.get('trimRight', 0.0))
+				self._track.clips.append(self._clip)
+
+		elif self._clip is None:
+			pass
+
+		elif depth == 4:
+			if tag == 'sequence' and self._clip.sequence is None:
+				self._sequence = Sequence(
+					int(attrib['maxsamples']),
+					int(attrib['sampleformat']),
+					int(attrib['numsamples']))
+				self._clip.sequence = self._sequence
+
+			elif tag == 'envelope' and len(self._clip.envelope) == 0:
+				self._in_envelope = True
+
+		elif depth == 5:
+			if tag == 'waveblock' and self._sequence is not None:
+				self._waveblock_start = int(attrib['start'])
+
+				blockid = attrib.get('blockid')
+				if blockid is not None:
+					# Audacity 3 blocks are in the project database, and negative ids are silences of that length.
+					# Lengths of other blocks aren't saved, they are deduced once the sequence is complete.
+					blockid = int(blockid)
+					if blockid < 0:
+						self._sequence.append_block(BLOCK_SILENT, self._waveblock_start, -blockid)
+					else:
+						self._sequence.append_block(BLOCK_SIMPLE, self._waveblock_start, 0, str(blockid))
+
+			elif tag == 'controlpoint' and self._in_envelope:
+				self._clip.envelope.append(EnvelopePoint(float(attrib['t']), float(attrib['val'])))
+
+		elif depth == 6 and self._sequence is not None:
+			btag = tag
+
+			if btag == 'simpleblockfile':
+				self._sequence.append_block(BLOCK_SIMPLE, self._waveblock_start, int(attrib['len']),
+					unescape(attrib['filename']),
+					float(attrib['min']), float(attrib['max']), float(attrib['rms']))
+
+			elif btag == 'pcmaliasblockfile':
+				self._sequence.append_block(BLOCK_PCMALIAS, self._waveblock_start, int(attrib['aliaslen']),
+					unescape(attrib['aliasfile']),
+					float(attrib['min']), float(attrib['max']), float(attrib['rms']),
+					file_start=int(attrib['aliasstart']),
+					channel=int(attrib['aliaschannel']),
+					summary_file=attrib['summaryfile'])
+
+			elif btag == 'silentblockfile':
+				self._sequence.append_block(BLOCK_SILENT, self._waveblock_start, int(attrib['len']))
+
+			else:
+				print("WARNING: Unknown block type: '{0}'".format(btag))
+
+	def end(self, tag):
+		depth = self.depth
+		self.depth -= 1
+
+		if depth == 2:
+			self._track = None
+		elif depth == 3:
+			self._clip = None
+		elif depth == 4:
+			if self.db_path is not None and self._sequence is not None:
+				sequence = self._sequence
+				starts = sequence.block_starts
+				for i in range(sequence.get_block_count()):
+					end = starts[i + 1] if i + 1 < len(starts) else sequence.numsamples
+					sequence.block_lens[i] = end - starts[i]
+			self._sequence = None
+			self._in_envelope = False
+
+
+def get_audacity_data_dir(fpath):
+	# Returns where the block files of an .aup project are, or "" if it has none
 	data_dir = os.path.splitext(fpath)[0] + '_data'
 	if not os.path.isdir(data_dir):
 		data_dir = ""
+	return data_dir
 
-	def unescape(s):
-		return html.unescape(s)
 
-	output = {
-		'rate': rate,
-		'name': unescape(name),
-		'data_dir': data_dir,
-		'tracks': []
-	}
+def load_audacity_project(fpath, cache_path=None, refresh_cache=False):
+	# If cache_path is given, the project is loaded from there when the file didn't change since it was saved
+	# (see ProjectCache), and saved there otherwise. refresh_cache ignores what was saved.
+	cache = None
+	if cache_path is not None:
+		cache = ProjectCache(cache_path)
+		if not refresh_cache:
+			project = cache.load(fpath)
+			if project is not None:
+				return project
 
-	for project_item in root:
-		tag = project_item.tag.split('}')[1]
-
-		if tag == 'wavetrack':
-
-			o_track = {
-				'name': unescape(project_item.attrib['name']),
-				'channel': int(project_item.attrib['channel']),
-				'linked': True if project_item.attrib['linked'] == '1' else False,
-				'mute': True if project_item.attrib['mute'] == '1' else False,
-				'solo': True if project_item.attrib['solo'] == '1' else False,
-				'rate': int(project_item.attrib['rate']),
-				'gain': float(project_item.attrib['gain']),
-				'pan': float(project_item.attrib['pan']),
-				'color_index': int(project_item.attrib['colorindex']),
-				'clips': []
-			}
+	if fpath.lower().endswith('.aup3'):
+		project = load_audacity3_project(fpath)
+	else:
+		project = load_audacity_xml_project(fpath)
 
-			output['tracks'].append(o_track)
+	if cache is not None and project is not None:
+		cache.save(fpath, project)
 
-			waveclips = project_item.findall('ns:waveclip', ns)
+	return project
 
-			for waveclip in waveclips:
 
-				o_clip = {
-					'offset': float(waveclip.attrib['offset']),
-					'color_index': int(waveclip.attrib['colorindex']),
-				}
+def load_audacity_xml_project(fpath):
+	builder = AudacityProjectBuilder(get_audacity_data_dir(fpath))
 
-				o_track['clips'].append(o_clip)
+	# Parse incrementally and drop elements as soon as they are processed,
+	# so memory doesn't grow with the size of the document.
+	# Elements are removed from their parent, otherwise it would still reference them.
+	parents = []
+	for event, elem in ET.iterparse(fpath, events=('start', 'end')):
+		tag = elem.tag.rsplit('}', 1)[-1]
 
-				sequence = waveclip.findall('ns:sequence', ns)[0]
-				o_sequence = {
-					'max_samples': int(sequence.attrib['maxsamples']),
-					'sample_format': int(sequence.attrib['sampleformat']),
-					'numsamples': int(sequence.attrib['numsamples']),
-					'blocks': []
-				}
+		if event == 'start':
+			builder.start(tag, elem.attrib)
+			parents.append(elem)
+
+		else:
+			builder.end(tag)
+			parents.pop()
+			elem.clear()
+			if len(parents) != 0:
+				parents[-1].remove(elem)
+
+	return builder.project
+
+
+# Types of fields in Audacity's binary XML, see ProjectSerializer.cpp
+FT_CHAR_SIZE = 0
+FT_START_TAG = 1
+FT_END_TAG = 2
+FT_STRING = 3
+FT_INT = 4
+FT_BOOL = 5
+FT_LONG = 6
+FT_LONG_LONG = 7
+FT_SIZE_T = 8
+FT_FLOAT = 9
+FT_DOUBLE = 10
+FT_DATA = 11
+FT_RAW = 12
+FT_PUSH = 13
+FT_POP = 14
+FT_NAME = 15
+
+# Text encoding used for each character size, which is the size of wxChar on the machine that saved the project
+_BINARY_XML_ENCODINGS = {
+	1: 'utf-8',
+	2: 'utf-16-le',
+	4: 'utf-32-le'
+}
+
+
+def parse_binary_xml(data, handler):
+	# Decodes XML saved by Audacity 3 in its binary form, and calls handler.start(tag, attrib)
+	# and handler.end(tag) for each element, with attribute values as strings like XML would have them.
+	# `data` is the `dict` blob of the project followed by its `doc` blob, the first one defining names used in the second.
+	names = {}
+	encoding = 'utf-32-le'
+	tag = None
+	attrib = None
+	pos = 0
+	size = len(data)
+
+	def read(fmt):
+		nonlocal pos
+		values = struct.unpack_from(fmt, data, pos)
+		pos += struct.calcsize(fmt)
+		return values
+
+	def read_text(nbytes):
+		nonlocal pos
+		text = data[pos:pos + nbytes].decode(encoding)
+		pos += nbytes
+		return text
+
+	def flush_start():
+		nonlocal tag, attrib
+		if tag is not None:
+			handler.start(tag, attrib)
+			tag = None
+			attrib = None
+
+	while pos < size:
+		ft = data[pos]
+		pos += 1
+
+		if ft == FT_CHAR_SIZE:
+			encoding = _BINARY_XML_ENCODINGS[data[pos]]
+			pos += 1
+
+		elif ft == FT_NAME:
+			name_id, nbytes = read('<HH')
+			names[name_id] = read_text(nbytes)
+
+		elif ft == FT_START_TAG:
+			flush_start()
+			tag = names[read('<H')[0]]
+			attrib = {}
+
+		elif ft == FT_END_TAG:
+			flush_start()
+			handler.end(names[read('<H')[0]])
+
+		elif ft == FT_STRING:
+			name_id, nbytes = read('<Hi')
+			attrib[names[name_id]] = read_text(nbytes)
+
+		elif ft == FT_INT or ft == FT_LONG or ft == FT_SIZE_T:
+			name_id, v = read('<Hi')
+			attrib[names[name_id]] = str(v)
+
+		elif ft == FT_BOOL:
+			name_id, v = read('<HB')
+			attrib[names[name_id]] = '1' if v else '0'
+
+		elif ft == FT_LONG_LONG:
+			name_id, v = read('<Hq')
+			attrib[names[name_id]] = str(v)
+
+		elif ft == FT_FLOAT:
+			name_id, v, digits = read('<Hfi')
+			attrib[names[name_id]] = '{0:.9g}'.format(v)
+
+		elif ft == FT_DOUBLE:
+			name_id, v, digits = read('<Hdi')
+			attrib[names[name_id]] = '{0:.17g}'.format(v)
+
+		elif ft == FT_DATA or ft == FT_RAW:
+			# Text content or raw XML, which we don't need
+			nbytes = read('<i')[0]
+			pos += nbytes
+
+		elif ft == FT_PUSH or ft == FT_POP:
+			pass
 
-				o_clip['sequence'] = o_sequence
+		else:
+			raise ValueError("Unknown field type {0} at offset {1}".format(ft, pos - 1))
 
-				for waveblock in sequence.findall('ns:waveblock', ns):
+	flush_start()
 
-					waveblock_start = int(waveblock.attrib['start'])
 
-					for block in waveblock:
-						btag = block.tag.split('}')[1]
+def load_audacity3_project(fpath):
+	# Loads an Audacity 3 project, which is a SQLite database.
+	# Its XML is stored in a binary form, and blocks are rows of the `sampleblocks` table.
+	connection = get_sqlite_connection(fpath)
 
-						if btag == 'simpleblockfile':
+	row = connection.execute('SELECT dict, doc FROM autosave WHERE id = 1').fetchone()
+	if row is not None:
+		print("WARNING: Project has unsaved changes from a crash, they will be ignored. "
+			"Open it in Audacity to recover them.")
 
-							o_sequence['blocks'].append({
-								'type': btag,
-								'start': waveblock_start,
-								'len': int(block.attrib['len']),
-								'filename': unescape(block.attrib['filename']),
-								'min': float(block.attrib['min']),
-								'max': float(block.attrib['max']),
-								'rms': float(block.attrib['rms']),
-							})
+	row = connection.execute('SELECT dict, doc FROM project WHERE id = 1').fetchone()
+	if row is None:
+		print("ERROR: No project found in ", fpath)
+		return None
 
-						elif btag == 'pcmaliasblockfile':
+	builder = AudacityProjectBuilder("", fpath)
+	parse_binary_xml(bytes(row[0]) + bytes(row[1]), builder)
+	project = builder.project
 
-							o_sequence['blocks'].append({
-								'type': btag,
-								'start': waveblock_start,
-								'len': int(block.attrib['aliaslen']),
-								'file_start': int(block.attrib['aliasstart']),
-								'filename': unescape(block.attrib['aliasfile']),
-								'summary_file': block.attrib['summaryfile'],
-								'channel': int(block.attrib['aliaschannel']),
-								'min': float(block.attrib['min']),
-								'max': float(block.attrib['max']),
-								'rms': float(block.attrib['rms'])
-							})
+	# Block summaries are not in the XML, get them all in a few queries
+	sequences_by_blockid = {}
+	for track in project.tracks:
+		for clip in track.clips:
+			sequence = clip.sequence
+			if sequence is None:
+				continue
+			for block_index in range(sequence.get_block_count()):
+				if sequence.block_types[block_index] == BLOCK_SIMPLE:
+					sequences_by_blockid.setdefault(int(sequence.block_filenames[block_index]), []).append(
+						(sequence, block_index))
+
+	found_count = 0
+	rows = iterate_sqlite_rows_by_id(connection,
+		'SELECT blockid, summin, summax, sumrms FROM sampleblocks WHERE blockid IN ({0}) ORDER BY blockid',
+		sequences_by_blockid.keys())
+	for blockid, bmin, bmax, rms in rows:
+		found_count += 1
+		for sequence, block_index in sequences_by_blockid[blockid]:
+			sequence.block_mins[block_index] = bmin
+			sequence.block_maxs[block_index] = bmax
+			sequence.block_rmss[block_index] = rms
+
+	if found_count != len(sequences_by_blockid):
+		print("WARNING: {0} blocks are missing from the project".format(len(sequences_by_blockid) - found_count))
+
+	return project
+
+
+class ProjectCache:
+	# Saves a loaded project in a compact binary form, so loading it again doesn't need to parse it.
+	# The file starts with the size of what identifies the project it was saved from,
+	# so it can be checked without reading the rest.
+	# Size and modification time are checked first, then a hash of the content in case they didn't change.
+	# Sequence columns are saved as the bytes of their arrays.
+
+	FILENAME = 'project_cache.bin'
+	VERSION = 1
+
+	SEQUENCE_COLUMNS = (
+		'block_types', 'block_starts', 'block_lens', 'block_mins', 'block_maxs', 'block_rmss',
+		'block_file_starts', 'block_channels'
+	)
+
+	def __init__(self, cache_path):
+		self.cache_path = cache_path
+
+	@staticmethod
+	def _get_content_hash(fpath):
+		h = hashlib.sha1()
+		if fpath.lower().endswith('.aup3'):
+			# Samples don't need to be hashed, blocks are never modified, only replaced by new ones
+			connection = get_sqlite_connection(fpath)
+			for table in ('project', 'autosave'):
+				row = connection.execute('SELECT dict, doc FROM {0} WHERE id = 1'.format(table)).fetchone()
+				h.update(table.encode('utf-8'))
+				if row is not None:
+					h.update(row[0] or b'')
+					h.update(row[1] or b'')
+		else:
+			with open(fpath, 'rb') as f:
+				while True:
+					data = f.read(COPY_BUFFER_SIZE)
+					if len(data) == 0:
+						break
+					h.update(data)
+		return h.hexdigest()
+
+	@staticmethod
+	def _get_file_identity(fpath):
+		st = os.stat(fpath)
+		return [os.path.abspath(fpath), st.st_size, st.st_mtime_ns]
+
+	@staticmethod
+	def _join_names(names):
+		# Block file names as one string, which is a lot faster to load than as many strings.
+		# None becomes an empty name.
+		return '\0'.join('' if name is None else name for name in names)
+
+	@staticmethod
+	def _split_names(joined):
+		if len(joined) == 0:
+			return []
+		names = joined.split('\0')
+		if '' in names:
+			names = [None if name == '' else name for name in names]
+		return names
+
+	def load(self, fpath):
+		# Returns the saved project, or None if there is none or the file changed since
+		if not os.path.isfile(self.cache_path):
+			return None
+		try:
+			with open(self.cache_path, 'rb') as f:
+				header_size = struct.unpack('<I', f.read(4))[0]
+				header = marshal.loads(f.read(header_size))
+				if header[0] != self.VERSION or header[1] != sys.byteorder \
+					or header[2] != self._get_file_identity(fpath) \
+					or header[3] != self._get_content_hash(fpath):
+					return None
+				# marshal.load() reads files in tiny pieces, loads() from one read is much faster
+				d = marshal.loads(f.read())
+		except (OSError, ValueError, EOFError, TypeError, IndexError, struct.error, sqlite3.Error) as e:
+			print("WARNING: Could not load project cache {0}: {1}".format(self.cache_path, e))
+			return None
+
+		if fpath.lower().endswith('.aup3'):
+			project = Project(d[0], d[1], "", fpath)
+		else:
+			project = Project(d[0], d[1], get_audacity_data_dir(fpath))
+
+		for td in d[2]:
+			track = Track()
+			track.name, track.channel, track.linked, track.mute, track.solo, \
+				track.rate, track.gain, track.pan, track.color_index = td[:9]
+
+			for cd in td[9]:
+				clip = Clip(cd[0], cd[1])
+				clip.trim_left = cd[2]
+				clip.trim_right = cd[3]
+				ts = array.array('d', cd[4])
+				vals = array.array('d', cd[5])
+				clip.envelope = [EnvelopePoint(t, val) for t, val in zip(ts, vals)]
+
+				sd = cd[6]
+				if sd is not None:
+					sequence = Sequence(sd[0], sd[1], sd[2])
+					for name, data in zip(self.SEQUENCE_COLUMNS, sd[3]):
+						getattr(sequence, name).frombytes(data)
+					sequence.block_filenames = self._split_names(sd[4])
+					sequence.block_summary_files = sd[5]
+					clip.sequence = sequence
+
+				track.clips.append(clip)
+			project.tracks.append(track)
+
+		return project
+
+	def save(self, fpath, project):
+		try:
+			header = [self.VERSION, sys.byteorder, self._get_file_identity(fpath), self._get_content_hash(fpath)]
+		except (OSError, sqlite3.Error) as e:
+			print("WARNING: Could not save project cache {0}: {1}".format(self.cache_path, e))
+			return
 
-						elif btag == 'silentblockfile':
+		tracks = []
+		for track in project.tracks:
+			clips = []
+			for clip in track.clips:
+				sd = None
+				sequence = clip.sequence
+				if sequence is not None:
+					sd = (sequence.max_samples, sequence.sample_format, sequence.numsamples,
+						tuple(getattr(sequence, name).tobytes() for name in self.SEQUENCE_COLUMNS),
+						self._join_names(sequence.block_filenames), sequence.block_summary_files)
+				clips.append((clip.offset, clip.color_index, clip.trim_left, clip.trim_right,
+					array.array('d', (p.t for p in clip.envelope)).tobytes(),
+					array.array('d', (p.val for p in clip.envelope)).tobytes(),
+					sd))
+			tracks.append((track.name, track.channel, track.linked, track.mute, track.solo,
+				track.rate, track.gain, track.pan, track.color_index, clips))
+
+		cache_dir = os.path.dirname(self.cache_path)
+		if cache_dir != "" and not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		temp_path = self.cache_path + '.tmp'
+		header_data = marshal.dumps(header)
+		with open(temp_path, 'wb') as f:
+			f.write(struct.pack('<I', len(header_data)))
+			f.write(header_data)
+			f.write(marshal.dumps((project.rate, project.name, tracks)))
+		os.replace(temp_path, self.cache_path)
+
+
+# Incomplete cache entries younger than this, in seconds, are assumed to still be written by another process
+CACHE_STALE_ENTRY_AGE = 3600
+
+
+class WavCache:
+	# Directory of converted WAV files which can be shared between projects.
+	# Files are named after a hash of the ordered blocks they were converted from,
+	# and the least recently used ones get evicted when the directory gets too big.
+	# This gets sent to worker processes, so it only holds plain data.
+
+	def __init__(self, cache_dir, max_size=None, hash_content=False, by_name=False):
+		self.cache_dir = cache_dir
+		self.max_size = max_size
+		# By default, block files are identified by absolute path, size and modification time.
+		# Hashing their content costs a full read, but also finds the same blocks in copies of a project.
+		self.hash_content = hash_content
+		# If True, block files are only identified by name and size. It's faster, but only safe if the cache
+		# is used by a single project: Audacity uses the same names in every project, and full blocks have the same size.
+		self.by_name = by_name
+
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+
+	def get_key(self, task):
+		h = hashlib.sha1()
+		h.update(task['format'].encode('utf-8'))
+		h.update(b'|dither' if task['dither'] else b'')
+
+		for src_paths_by_channel, numsamples in task['segments']:
+			h.update('|segment{0}'.format(numsamples).encode('utf-8'))
+
+			for channel, src_paths in enumerate(src_paths_by_channel):
+				h.update('|channel{0}'.format(channel).encode('utf-8'))
+				self._hash_src_paths(h, src_paths)
+
+		return h.hexdigest()
+
+	def _hash_src_paths(self, h, src_paths):
+		for src_path in src_paths:
+			if src_path is None:
+				h.update(b'|silent')
+			elif isinstance(src_path, SqliteBlock):
+				if self.hash_content:
+					h.update(read_sqlite_block_data(src_path))
+				else:
+					# Block ids are only unique within a project
+					h.update('|{0}#{1}:{2}'.format(os.path.abspath(src_path.db_path), src_path.blockid,
+						get_block_size(src_path)).encode('utf-8'))
+			elif self.hash_content:
+				with open(src_path, 'rb') as f:
+					for d in iter(lambda: f.read(1024 * 1024), b''):
+						h.update(d)
+			elif self.by_name:
+				h.update('|{0}:{1}'.format(os.path.basename(src_path), os.path.getsize(src_path)).encode('utf-8'))
+			else:
+				st = os.stat(src_path)
+				h.update('|{0}:{1}:{2}'.format(os.path.abspath(src_path), st.st_size, st.st_mtime_ns).encode('utf-8'))
+
+	def _get_path(self, key):
+		return os.path.join(self.cache_dir, key + '.wav')
+
+	def fetch(self, key, dst_path, peaks_path=None):
+		# Puts the cached file for that key at dst_path, and its peaks at peaks_path if given.
+		# Returns how many samples it contains, or None if it is not in the cache.
+		cached_path = self._get_path(key)
+		samples_path = cached_path + '.samples'
+
+		try:
+			with open(samples_path, 'r') as f:
+				samples_count = int(f.read())
+			if peaks_path is not None:
+				# Copied rather than linked, because it gets modified to match the file it is next to
+				shutil.copyfile(cached_path + REAPEAKS_EXTENSION, peaks_path)
+			_link_or_copy_file(cached_path, dst_path)
+		except (OSError, ValueError):
+			return None
+
+		if peaks_path is not None:
+			update_reapeaks_source_info(peaks_path, dst_path)
+
+		# Mark as recently used
+		os.utime(samples_path)
+
+		print("Reusing cached ", cached_path)
+		return samples_count
+
+	def store(self, key, src_path, samples_count, peaks_path=None):
+		cached_path = self._get_path(key)
+		samples_path = cached_path + '.samples'
+
+		# Write under a temporary name first, so other processes never see half-written entries
+		temp_suffix = '.{0}.tmp'.format(os.getpid())
+		if peaks_path is not None:
+			shutil.copyfile(peaks_path, cached_path + REAPEAKS_EXTENSION + temp_suffix)
+			os.replace(cached_path + REAPEAKS_EXTENSION + temp_suffix, cached_path + REAPEAKS_EXTENSION)
+		_link_or_copy_file(src_path, cached_path + temp_suffix)
+		os.replace(cached_path + temp_suffix, cached_path)
+		with open(samples_path + temp_suffix, 'w') as f:
+			f.write(str(samples_count))
+		os.replace(samples_path + temp_suffix, samples_path)
+
+		if self.max_size is not None:
+			self.evict(self.max_size)
+
+	def evict(self, max_size):
+		# Removes least recently used entries until the cache fits in max_size bytes.
+		# Every file of an entry counts, the WAV as well as its peaks, sample count and temporary files.
+		files_by_key = {}
+
+		for entry in os.scandir(self.cache_dir):
+			if not entry.is_file():
+				continue
+			try:
+				st = entry.stat()
+			except OSError:
+				# Another process got there first
+				continue
+			# Files of an entry are all named after its key
+			key = entry.name.split('.', 1)[0]
+			files_by_key.setdefault(key, []).append((entry.name, entry.path, st.st_size, st.st_mtime))
+
+		entries = []
+		total_size = 0
+		now = time.time()
+
+		for key, files in files_by_key.items():
+			size = sum(f[2] for f in files)
+			total_size += size
+			last_uses = [f[3] for f in files if f[0] == key + '.wav.samples']
+			if len(last_uses) != 0:
+				last_use = last_uses[0]
+			else:
+				# Being stored by another process, or left over by one that was interrupted
+				last_use = max(f[3] for f in files)
+				if now - last_use < CACHE_STALE_ENTRY_AGE:
+					continue
+			entries.append((last_use, size, [f[1] for f in files]))
 
-							o_sequence['blocks'].append({
-								'type': btag,
-								'len': int(block.attrib['len'])
-							})
+		entries.sort()
 
-						else:
-							print("WARNING: Unknown block type: '{0}'".format(btag))
+		for last_use, size, paths in entries:
+			if total_size <= max_size:
+				break
+			# The sample count goes first, so the entry can't be fetched anymore
+			for path in sorted(paths, key=lambda path: not path.endswith('.samples')):
+				try:
+					os.remove(path)
+				except OSError:
+					pass
+			total_size -= size
+
+
+def _link_or_copy_file(src_path, dst_path):
+	# Hard links are way cheaper, but only work within the same file system
+	try:
+		os.link(src_path, dst_path)
+	except OSError:
+		shutil.copyfile(src_path, dst_path)
+
+
+class ConversionManifest:
+	# Remembers which block files each converted file was made from, along with their size and time of modification,
+	# so a later conversion into the same directory can skip files whose blocks didn't change.
+
+	FILENAME = 'manifest.json'
+	VERSION = 4
+
+	def __init__(self, target_dir):
+		self.target_dir = target_dir
+		self.path = os.path.join(target_dir, self.FILENAME)
+		# Entries by converted file name
+		self.entries = {}
+
+	def load(self):
+		try:
+			with open(self.path, 'r', encoding='utf-8') as f:
+				data = json.load(f)
+		except (OSError, ValueError):
+			return
 
-				envelope = waveclip.findall('ns:envelope', ns)[0]
-				points = []
-				for point in envelope.findall('ns:controlpoint', ns):
-					points.append({
-						't': float(point.attrib['t']),
-						'val': float(point.attrib['val'])
-					})
+		if data.get('version') != self.VERSION:
+			return
 
-				o_clip['envelope'] = {
-					'points': points
-				}
+		self.entries = data['files']
+
+	def save(self):
+		temp_path = self.path + '.tmp'
+		with open(temp_path, 'w', encoding='utf-8') as f:
+			json.dump({ 'version': self.VERSION, 'files': self.entries }, f, sort_keys=True)
+		os.replace(temp_path, self.path)
+
+	def _get_inputs(self, task):
+		inputs = []
+		for src_paths_by_channel, numsamples in task['segments']:
+			segment_inputs = []
+			for src_paths in src_paths_by_channel:
+				channel_inputs = []
+				for src_path in src_paths:
+					if src_path is None:
+						channel_inputs.append(None)
+					else:
+						channel_inputs.append(get_block_signature(src_path, self.target_dir))
+				segment_inputs.append(channel_inputs)
+			inputs.append([numsamples, segment_inputs])
+		return inputs
+
+	def get_up_to_date_samples(self, task):
+		# Returns how many samples the converted file of that task has if it doesn't need to be rebuilt, None otherwise
+		name = os.path.basename(task['dst_path'])
+		entry = self.entries.get(name)
+
+		if entry is None or entry['format'] != task['format'] or entry['dither'] != task['dither']:
+			return None
+		if not os.path.isfile(task['dst_path']):
+			return None
+
+		try:
+			if entry['inputs'] != self._get_inputs(task):
+				return None
+		except (OSError, KeyError, sqlite3.Error):
+			return None
+
+		return entry['numsamples']
+
+	def record(self, task, samples_in_file):
+		self.entries[os.path.basename(task['dst_path'])] = {
+			'format': task['format'],
+			'dither': task['dither'],
+			'numsamples': samples_in_file,
+			'inputs': self._get_inputs(task)
+		}
 
-	return output
+	def remove_unreferenced(self, dst_paths):
+		# Deletes files converted previously which are not among dst_paths anymore.
+		# Returns how many were deleted.
+		names = set(os.path.basename(p) for p in dst_paths)
+		removed_count = 0
 
+		for name in list(self.entries.keys()):
+			if name in names:
+				continue
+			del self.entries[name]
+			fpath = os.path.join(self.target_dir, name)
+			if os.path.isfile(fpath):
+				print("Removing unreferenced ", fpath)
+				os.remove(fpath)
+				removed_count += 1
+			if os.path.isfile(fpath + REAPEAKS_EXTENSION):
+				os.remove(fpath + REAPEAKS_EXTENSION)
+
+		return removed_count
+
+
+def get_peak_memory():
+	# Returns the peak resident memory of this process and of its finished child processes in bytes,
+	# or (None, None) if we can't know
+	if resource is None:
+		return None, None
+	# Kilobytes on Linux, bytes on macOS
+	unit = 1 if sys.platform == 'darwin' else 1024
+	return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+		resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+
+# CPU time of the calling thread, so stages measured on different threads don't count each other's time.
+# Only available since Python 3.7, process time is the closest before that.
+_get_thread_cpu_time = getattr(time, 'thread_time', time.process_time)
+
+
+class ConversionStats:
+	# Measures where time goes during a conversion: wall and CPU time of each stage,
+	# bytes read and written, blocks processed and peak memory.
+	# Stages measured in worker processes are merged in from task results.
+	# If progress_callback is given, it gets called as clips get converted, with
+	# (converted_tasks, total_tasks, elapsed_seconds, remaining_seconds). The estimate is None until known.
+
+	def __init__(self, progress_callback=None):
+		# [wall time, CPU time, count] by stage name
+		self.stages = {}
+		self.bytes_read = 0
+		self.bytes_written = 0
+		self.blocks = 0
+		self.tasks = 0
+		self.failed_tasks = 0
+		self.progress_callback = progress_callback
+		self.start_time = time.perf_counter()
+		# Stages can be measured from several threads, see convert_au_segments_to_wav
+		self._lock = threading.Lock()
+
+	@contextlib.contextmanager
+	def measure(self, stage):
+		wall_time = time.perf_counter()
+		cpu_time = _get_thread_cpu_time()
+		try:
+			yield
+		finally:
+			self.add_stage_time(stage, time.perf_counter() - wall_time, _get_thread_cpu_time() - cpu_time)
+
+	def add_stage_time(self, stage, wall_time, cpu_time, count=1):
+		with self._lock:
+			times = self.stages.get(stage)
+			if times is None:
+				self.stages[stage] = [wall_time, cpu_time, count]
+			else:
+				times[0] += wall_time
+				times[1] += cpu_time
+				times[2] += count
+
+	def add_task_result(self, result):
+		# Merges what run_conversion_task measured
+		self.tasks += 1
+		if result['error'] is not None:
+			self.failed_tasks += 1
+		self.bytes_read += result['bytes_read']
+		self.bytes_written += result['bytes_written']
+		self.blocks += result['blocks']
+		for stage, times in result['stages'].items():
+			self.add_stage_time(stage, *times)
+
+	def report_progress(self, done_count, total_count, done_samples, total_samples):
+		if self.progress_callback is None:
+			return
+		elapsed = time.perf_counter() - self.start_time
+		remaining = None
+		if done_samples > 0:
+			remaining = elapsed * (total_samples - done_samples) / done_samples
+		self.progress_callback(done_count, total_count, elapsed, remaining)
+
+	def to_dict(self):
+		peak_memory, peak_worker_memory = get_peak_memory()
+		wall_time = time.perf_counter() - self.start_time
+		stages = {}
+		for stage, (stage_wall_time, stage_cpu_time, count) in self.stages.items():
+			stages[stage] = {
+				'wall_time': stage_wall_time,
+				'cpu_time': stage_cpu_time,
+				'count': count
+			}
+		return {
+			'wall_time': wall_time,
+			'stages': stages,
+			'tasks': self.tasks,
+			'failed_tasks': self.failed_tasks,
+			'blocks': self.blocks,
+			'bytes_read': self.bytes_read,
+			'bytes_written': self.bytes_written,
+			'read_mb_per_second': self.bytes_read / (1024.0 * 1024.0) / wall_time if wall_time > 0 else 0.0,
+			'peak_memory': peak_memory,
+			'peak_worker_memory': peak_worker_memory
+		}
 
-def convert_au_files_from_audacity_project(project, target_dir):
+	def save(self, fpath):
+		with open(fpath, 'w', encoding='utf-8') as f:
+			json.dump(self.to_dict(), f, indent=4, sort_keys=True)
+
+	def print_summary(self):
+		mb = 1024.0 * 1024.0
+		d = self.to_dict()
+		print("")
+		print("{0:>20} {1:>10} {2:>10} {3:>8}".format('Stage', 'Wall (s)', 'CPU (s)', 'Count'))
+		for stage, times in sorted(d['stages'].items()):
+			print("{0:>20} {1:>10.3f} {2:>10.3f} {3:>8}".format(stage, times['wall_time'], times['cpu_time'], times['count']))
+		print("Total {0:.2f}s, {1} tasks ({2} failed), {3} blocks, read {4:.2f} MB ({5:.2f} MB/s), wrote {6:.2f} MB".format(
+			d['wall_time'], d['tasks'], d['failed_tasks'], d['blocks'],
+			d['bytes_read'] / mb, d['read_mb_per_second'], d['bytes_written'] / mb))
+		if d['peak_memory'] is not None:
+			print("Peak memory {0:.2f} MB, workers {1:.2f} MB".format(d['peak_memory'] / mb, d['peak_worker_memory'] / mb))
+
+
+# 'split' makes separate items around silences,
+# 'sparse' keeps them in the same file as holes, which don't take space on file systems supporting them
+SILENCE_MODES = ('split', 'sparse')
+
+
+class ConversionSettings:
+	# Options of the conversion, with their defaults.
+	# This gets sent to worker processes, so it only holds plain data.
+
+	def __init__(self):
+		# Upper bound for the memory holding samples while converting a clip
+		self.max_buffer_size = DEFAULT_MAX_BUFFER_SIZE
+		# Number of clips converted in parallel. 0 uses all CPU cores.
+		self.jobs = 1
+		# Optional WavCache to reuse files converted previously
+		self.cache = None
+		# If True, only clips whose block files changed since the last conversion are converted again
+		self.incremental = True
+		# One of OUTPUT_FORMATS. None keeps the sample format of the Audacity project.
+		self.output_format = None
+		# Add noise when reducing to a smaller integer format, rather than just rounding
+		self.dither = False
+		# If True, all clips of a track go into one file, and items refer to sections of it
+		self.consolidate = False
+		# If True, GUIDs in the Reaper project are derived from what they identify rather than random
+		self.deterministic_guids = False
+		# Number of block files read ahead while converting a clip, see convert_au_segments_to_wav.
+		# 0 reads them one after the other.
+		self.read_ahead = 0
+		# If True, Reaper peak files are written next to converted files
+		self.peaks = False
+		# What silent blocks in the middle of clips become, one of SILENCE_MODES
+		self.silence = 'split'
+		# Envelope points are removed as long as the envelope doesn't move by more than this many dB.
+		# 0 keeps all of them.
+		self.envelope_tolerance = 0.0
+		# If True, loaded projects are saved next to converted files to load faster next time, see ProjectCache.
+		self.project_cache = False
+		# If True, the saved project is ignored and replaced
+		self.refresh_project_cache = False
+
+
+def convert_au_files_from_audacity_project(project, target_dir, settings=None, stats=None):
 	# This is where most of the conversion happens.
+	# Clips are all gathered first as conversion tasks, and then converted, possibly in parallel.
+	# Measurements go into stats, if given (see ConversionStats).
+	# Returns how many clips failed to convert.
+
+	if settings is None:
+		settings = ConversionSettings()
+	if stats is None:
+		stats = ConversionStats()
+
+	with stats.measure('plan'):
+		tasks = plan_au_conversion(project, target_dir, settings)
+		manifest, pending_tasks = prepare_incremental_conversion(tasks, target_dir, settings)
+
+	results = run_conversion_tasks(pending_tasks, settings, stats)
+
+	return finish_incremental_conversion(manifest, tasks, pending_tasks, results)
+
+
+def get_sequence_output_format(sequence):
+	# Returns which of OUTPUT_FORMATS matches the samples of a sequence
+	output_format = AUDACITY_SAMPLE_FORMAT_OUTPUT_FORMATS.get(sequence.sample_format)
+	if output_format is None:
+		print("WARNING: Unknown sample format {0}, converting to float".format(sequence.sample_format))
+		output_format = 'float32'
+	return output_format
+
+
+def get_track_output_format(track, settings):
+	# Returns which of OUTPUT_FORMATS can hold all clips of a track without loss
+	if settings.output_format is not None:
+		return settings.output_format
+
+	formats = [get_sequence_output_format(clip.sequence) for clip in track.clips]
+	for output_format in ['float32', 'int24', 'int16']:
+		if output_format in formats:
+			return output_format
+	return 'int16'
+
+
+class BlockFileIndex:
+	# Finds block files of a project in its data directory.
+	# Audacity saves them under a nested hierarchy, which is derived from their name:
+	# e0012abc.au goes in e00/d12/. So we only list directories we need files from,
+	# and only scan the whole data directory if a file isn't where it should be,
+	# because data directories can have lots of files that the project doesn't even use anymore.
+	# Listings can be saved to a file so the next run only needs to check directories didn't change.
+
+	FILENAME = 'block_index.json'
+	VERSION = 1
+
+	def __init__(self, data_dir, cache_path=None):
+		self.data_dir = data_dir
+		self.cache_path = cache_path
+		# Names of files by directory path relative to data_dir
+		self._listings = {}
+		# Listings from the saved file, as [directory modification time, names]
+		self._cached_listings = {}
+		self._modified = False
+		# Paths of all files by name, once the whole directory has been scanned
+		self._all_files = None
+
+		if cache_path is not None and os.path.isfile(cache_path):
+			try:
+				with open(cache_path, 'r', encoding='utf-8') as f:
+					d = json.load(f)
+				if d.get('version') == self.VERSION and d.get('data_dir') == os.path.abspath(data_dir):
+					self._cached_listings = d['listings']
+			except (OSError, ValueError, KeyError) as e:
+				print("WARNING: Could not load block index {0}: {1}".format(cache_path, e))
+
+	@staticmethod
+	def get_expected_subdir(name):
+		# Returns where Audacity puts a block file with that name, relative to the data directory
+		if len(name) < 5 or name[0] != 'e':
+			return None
+		return os.path.join('e' + name[1:3], 'd' + name[3:5])
+
+	def _get_listing(self, subdir):
+		names = self._listings.get(subdir)
+		if names is not None:
+			return names
+
+		dpath = os.path.join(self.data_dir, subdir)
+		try:
+			mtime = os.stat(dpath).st_mtime_ns
+		except OSError:
+			names = frozenset()
+			self._listings[subdir] = names
+			return names
+
+		cached = self._cached_listings.get(subdir)
+		if cached is not None and cached[0] == mtime:
+			names = frozenset(cached[1])
+		else:
+			with os.scandir(dpath) as it:
+				names = frozenset(entry.name for entry in it if entry.is_file())
+			self._cached_listings[subdir] = [mtime, sorted(names)]
+			self._modified = True
+
+		self._listings[subdir] = names
+		return names
+
+	def _scan_all(self):
+		print("Scanning ", self.data_dir)
+		self._all_files = {}
+		dpaths = [self.data_dir]
+		while len(dpaths) != 0:
+			dpath = dpaths.pop()
+			try:
+				with os.scandir(dpath) as it:
+					for entry in it:
+						if entry.is_dir():
+							dpaths.append(entry.path)
+						else:
+							self._all_files.setdefault(entry.name, entry.path)
+			except OSError as e:
+				print("WARNING: Could not list {0}: {1}".format(dpath, e))
+
+	def get_path(self, name):
+		# Returns the path of a block file, or None if it can't be found
+		if self.data_dir == "":
+			return None
+
+		subdir = self.get_expected_subdir(name)
+		if subdir is not None and name in self._get_listing(subdir):
+			return os.path.join(self.data_dir, subdir, name)
+
+		# Not where it should be, look everywhere
+		if self._all_files is None:
+			self._scan_all()
+		return self._all_files.get(name)
+
+	def save(self):
+		if self.cache_path is None or not self._modified:
+			return
+		d = {
+			'version': self.VERSION,
+			'data_dir': os.path.abspath(self.data_dir),
+			'listings': self._cached_listings
+		}
+		temp_path = self.cache_path + '.tmp'
+		with open(temp_path, 'w', encoding='utf-8') as f:
+			json.dump(d, f, separators=(',', ':'))
+		os.replace(temp_path, self.cache_path)
+		self._modified = False
 
-	indexed_files = {}
 
-	if project['data_dir'] != "":
-		# Audacity saves its media files under a nested hierarchy,
-		# I don't quite understand why since files seem to have unique names
-		for root, dirs, files in os.walk(project['data_dir']):
-			for name in files:
-				indexed_files[name] = os.path.join(root, name)
+class SqliteBlockIndex:
+	# Does for blocks of Audacity 3 projects what BlockFileIndex does for .au files.
+	# Their name is their id in the project database.
+
+	def __init__(self, db_path, sample_rate):
+		self.db_path = db_path
+		self.sample_rate = sample_rate
 
-	if not os.path.isdir(target_dir):
+	def get_path(self, name):
+		return SqliteBlock(self.db_path, int(name), self.sample_rate)
+
+	def save(self):
+		pass
+
+
+def trim_converted_clips(converted_clips, first_index, clip, rate):
+	# Cuts items made from a clip to the part Audacity shows, for clips trimmed in Audacity 3.1 and later.
+	# Items starting before it are made to start later in their file, and those outside of it are removed.
+	visible_start = clip.offset + clip.trim_left
+	visible_end = clip.offset + clip.sequence.numsamples / rate - clip.trim_right
+
+	kept = []
+	for converted_clip in converted_clips[first_index:]:
+		start = converted_clip.offset
+		end = start + converted_clip.numsamples / rate
+		if end <= visible_start or start >= visible_end:
+			continue
+
+		if start < visible_start:
+			cut = int(round((visible_start - start) * rate))
+			converted_clip.offset = visible_start
+			converted_clip.numsamples -= cut
+			converted_clip.file_start = cut if converted_clip.file_start is None else converted_clip.file_start + cut
+
+		if end > visible_end:
+			converted_clip.numsamples -= int(round((end - visible_end) * rate))
+
+		kept.append(converted_clip)
+
+	converted_clips[first_index:] = kept
+
+
+def merge_envelope_runs(runs):
+	# Merges lists of EnvelopePoint which are each sorted by time into one.
+	# Clips are usually in time order and don't overlap, so runs just need to be put end to end.
+	# Otherwise, sorting merges them: Python's sort finds and merges runs already in order,
+	# which is faster than merging them one point at a time with heapq.merge.
+	# Points of different runs at the same time stay in the order of their runs.
+	points = []
+	in_order = True
+	for run in runs:
+		if len(points) != 0 and run[0].t < points[-1].t:
+			in_order = False
+		points.extend(run)
+	if not in_order:
+		points.sort(key=lambda p: p.t)
+	return points
+
+
+# Gain that envelope points of value zero are given when comparing them in dB
+ENVELOPE_MIN_DB = -150.0
+# Most points simplify_envelope looks at in one go
+ENVELOPE_SIMPLIFY_WINDOW = 4096
+
+
+def _envelope_value_to_db(val):
+	if val <= 0.0:
+		return ENVELOPE_MIN_DB
+	return max(20.0 * math.log10(val), ENVELOPE_MIN_DB)
+
+
+def simplify_envelope(points, tolerance_db):
+	# Removes envelope points that don't change the curve by more than tolerance_db,
+	# using Ramer-Douglas-Peucker on gains in dB. Each removed point is at most that far
+	# from the line joining the points kept around it, measured at its own time.
+	# Points must be sorted by time. Returns the list of points kept.
+	count = len(points)
+	if count <= 2 or tolerance_db <= 0.0:
+		return points
+
+	ts = [p.t for p in points]
+	dbs = [_envelope_value_to_db(p.val) for p in points]
+	if numpy is not None:
+		ts = numpy.array(ts)
+		dbs = numpy.array(dbs)
+
+	# Ranges left to look at. Not recursive, envelopes can have many points.
+	# Splitting a range can take off only a few points at a time, like on periodic envelopes,
+	# so the envelope is cut in windows first. Keeping the points between them costs little,
+	# and prevents from going through the whole envelope once per kept point.
+	keep = bytearray(count)
+	ranges = []
+	for first in range(0, count - 1, ENVELOPE_SIMPLIFY_WINDOW):
+		last = min(first + ENVELOPE_SIMPLIFY_WINDOW, count - 1)
+		keep[first] = 1
+		keep[last] = 1
+		ranges.append((first, last))
+	while len(ranges) != 0:
+		first, last = ranges.pop()
+		if last - first < 2:
+			continue
+
+		t0 = float(ts[first])
+		db0 = float(dbs[first])
+		dt = float(ts[last]) - t0
+		slope = (float(dbs[last]) - db0) / dt if dt != 0.0 else 0.0
+
+		if numpy is not None:
+			errors = numpy.abs(dbs[first + 1:last] - (db0 + (ts[first + 1:last] - t0) * slope))
+			i = int(errors.argmax())
+			max_error = float(errors[i])
+			max_index = first + 1 + i
+		else:
+			max_error = -1.0
+			max_index = first
+			for i in range(first + 1, last):
+				error = abs(dbs[i] - (db0 + (ts[i] - t0) * slope))
+				if error > max_error:
+					max_error = error
+					max_index = i
+
+		if max_error > tolerance_db:
+			keep[max_index] = 1
+			ranges.append((first, max_index))
+			ranges.append((max_index, last))
+
+	return [p for p, k in zip(points, keep) if k]
+
+
+def get_block_paths(sequence, zero_blocks, block_files):
+	# Returns the path of each block file of a sequence, None for those we don't need to read.
+	# Blocks whose file can't be found are marked in zero_blocks.
+	paths = [None] * sequence.get_block_count()
+	for block_index, (btype, filename) in enumerate(zip(sequence.block_types, sequence.block_filenames)):
+		if btype != BLOCK_SIMPLE or zero_blocks[block_index]:
+			continue
+		path = block_files.get_path(filename)
+		if path is None:
+			print("ERROR: Block file {0} not found, it will be replaced with silence".format(filename))
+			zero_blocks[block_index] = True
+		paths[block_index] = path
+	return paths
+
+
+def get_zero_blocks(sequence):
+	# Returns which blocks of a sequence only contain zeros according to their summary, as a list of booleans
+	return [btype == BLOCK_SIMPLE and bmin == 0.0 and bmax == 0.0
+		for btype, bmin, bmax in zip(sequence.block_types, sequence.block_mins, sequence.block_maxs)]
+
+
+def pair_stereo_blocks(sequence, sequence2):
+	# Audacity saves each channel of a stereo track as a separate sequence.
+	# For each simple block of the first one, finds the block of the second covering the same samples.
+	# Returns an array of block indices into sequence2, with -1 where there is no match.
+
+	index_by_start = {}
+	for i, (btype, start) in enumerate(zip(sequence2.block_types, sequence2.block_starts)):
+		if btype == BLOCK_SIMPLE:
+			index_by_start[start] = i
+
+	lens2 = sequence2.block_lens
+	pairs = array.array('q', [-1]) * sequence.get_block_count()
+
+	for i, (btype, start, length) in enumerate(zip(sequence.block_types, sequence.block_starts, sequence.block_lens)):
+		if btype == BLOCK_SIMPLE:
+			j = index_by_start.get(start, -1)
+			if j != -1 and lens2[j] == length:
+				pairs[i] = j
+
+	return pairs
+
+
+def report_unpaired_stereo_blocks(pairs, sequence, sequence2, clip_desc):
+	# Prints a warning if some simple blocks of either channel were not paired by pair_stereo_blocks
+	paired = set(pairs)
+
+	left_count = 0
+	for i, btype in enumerate(sequence.block_types):
+		if btype == BLOCK_SIMPLE and pairs[i] == -1:
+			left_count += 1
+
+	right_count = 0
+	for i, btype in enumerate(sequence2.block_types):
+		if btype == BLOCK_SIMPLE and i not in paired:
+			right_count += 1
+
+	if left_count != 0 or right_count != 0:
+		print("WARNING: Stereo blocks don't match in {0}".format(clip_desc))
+		print("         {0} left blocks have no right counterpart, {1} right blocks have no left counterpart".format(
+			left_count, right_count))
+		if right_count != 0:
+			print("         Unpaired right blocks will not be converted")
+
+
+def plan_au_conversion(project, target_dir, settings=None, on_disk=True):
+	# Figures out which files to convert the clips of the project into, and fills project.converted_tracks.
+	# Returns the list of conversion tasks to run so that these files exist.
+	# If on_disk is False, target_dir is only used to name files, and nothing gets written there (see convert_to_tar).
+
+	if settings is None:
+		settings = ConversionSettings()
+
+	if on_disk and not os.path.isdir(target_dir):
 		os.makedirs(target_dir)
 
-	tracks = project['tracks']
+	block_files = BlockFileIndex(project.data_dir,
+		os.path.join(target_dir, BlockFileIndex.FILENAME) if settings.incremental and on_disk else None)
+
+	tracks = project.tracks
 
-	# TODO Eventually just make an entirely new project dictionary rather than modifying the input one
 	converted_tracks = []
-	project['converted_tracks'] = converted_tracks
+	project.converted_tracks = converted_tracks
+
+	tasks = []
+	# Where the conversion of each sequence of blocks ends up, as (file path, sample offset)
+	locations_by_src_key = {}
 
 	for track_index, track in enumerate(tracks):
 
@@ -443,162 +2783,502 @@ def convert_au_files_from_audacity_project(project, target_dir):
 		next_track = None if track_index + 1 == len(tracks) else tracks[track_index + 1]
 		is_stereo_track = False
 
-		if track['channel'] == 1:
-			if previous_track is not None and previous_track['linked']:
+		if track.channel == 1:
+			if previous_track is not None and previous_track.linked:
 				# Ignore second channel of a linked stereo track,
 				# should be handled both in the previous iteration.
 				# This means a converted project may have less tracks.
 				continue
 
-		elif track['channel'] == 0 and track['linked']:
+		elif track.channel == 0 and track.linked:
 			is_stereo_track = True
 
-		converted_track = {
-			'name': track['name'],
-			'mute': track['mute'],
-			'solo': track['solo'],
-			'rate': track['rate'],
-			'gain': track['gain'],
-			'pan': track['pan'],
-			'color_index': track['color_index'],
-		}
-
+		converted_track = ConvertedTrack(track)
 		converted_tracks.append(converted_track)
 
-		converted_clips = []
-		converted_track['converted_clips'] = converted_clips
+		converted_clips = converted_track.clips
+		# Envelope points of each clip, sorted by time
+		envelope_runs = []
+
+		track_task = None
+		if settings.consolidate:
+			# All clips of the track go into the same file, one after the other
+			track_task = {
+				'segments': [],
+				'dst_path': os.path.join(target_dir, "track{0}.wav".format(track_index)),
+				'numsamples': 0,
+				'format': get_track_output_format(track, settings),
+				'dither': settings.dither,
+				'rate': track.rate
+			}
+
+		if project.db_path is not None:
+			block_files = SqliteBlockIndex(project.db_path, track.rate)
 
-		for clip_index, clip in enumerate(track['clips']):
+		for clip_index, clip in enumerate(track.clips):
 
-			sequence = clip['sequence']
+			sequence = clip.sequence
+			first_converted_clip_index = len(converted_clips)
 
 			au_fpaths = [[], []]
 			converted_numsamples = 0
-			converted_clip_start = clip['offset'] # In seconds
-
-			blocks = sequence['blocks']
+			converted_clip_start = clip.offset # In seconds
 
 			clip2 = None
 			if is_stereo_track:
-				clip2 = next_track['clips'][clip_index]
-				if clip2['offset'] != clip['offset']:
+				clip2 = next_track.clips[clip_index]
+				if clip2.offset != clip.offset:
 					print("WARNING: Stereo track has non-aligned clips??")
 					# Okayyy
 					clip2 = None
 
 			# Convert clip-wise envelopes into a track-wise one
-			if len(clip['envelope']['points']) > 0:
-
-				if 'envelope' not in converted_track:
-					converted_envelope = { 'points': [] }
-					converted_track['envelope'] = converted_envelope
-				else:
-					converted_envelope = converted_track['envelope']
-
-				# Note: points will be sorted once we have gone through all clips
-				points = clip['envelope']['points']
-				for p in points:
-					converted_envelope['points'].append({
-						't': p['t'],
-						'val': p['val']
-					})
+			if len(clip.envelope) > 0:
+				# Note: runs of points will be merged once we have gone through all clips
+				run = [EnvelopePoint(p.t, p.val) for p in clip.envelope]
+				if any(run[i].t > run[i + 1].t for i in range(len(run) - 1)):
+					# Audacity saves them in order, but don't rely on it
+					run.sort(key=lambda p: p.t)
+				envelope_runs.append(run)
+
+			if track_task is not None:
+				output_format = track_task['format']
+			else:
+				output_format = settings.output_format or get_sequence_output_format(sequence)
+
+			stereo_pairs = None
+			if clip2 is not None:
+				stereo_pairs = pair_stereo_blocks(sequence, clip2.sequence)
+				report_unpaired_stereo_blocks(stereo_pairs, sequence, clip2.sequence,
+					"{0} (track {1}), clip {2}".format(track.name, track_index, clip_index))
+
+			block_types = sequence.block_types
+			block_starts = sequence.block_starts
+			block_lens = sequence.block_lens
+			block_filenames = sequence.block_filenames
+			block_count = len(block_types)
+
+			# Blocks which only contain zeros are as good as silent blocks, and we don't need to read them.
+			# In stereo, a block is only silent if both channels are, otherwise the silent channel is left empty.
+			zero_blocks = get_zero_blocks(sequence)
+			zero_blocks2 = None if clip2 is None else get_zero_blocks(clip2.sequence)
+
+			# Missing block files get the same treatment, so the rest of the clip stays in place
+			block_paths = get_block_paths(sequence, zero_blocks, block_files)
+			block_paths2 = None if clip2 is None else get_block_paths(clip2.sequence, zero_blocks2, block_files)
+			effective_types = array.array('B', block_types)
+			for block_index in range(block_count):
+				if zero_blocks[block_index]:
+					if stereo_pairs is not None:
+						block2_index = stereo_pairs[block_index]
+						if block2_index != -1 and not zero_blocks2[block2_index]:
+							continue
+					effective_types[block_index] = BLOCK_SILENT
+
+			# Type of the next block which isn't silent, so we know if silence is followed by more of the same
+			next_data_types = [None] * block_count
+			next_data_type = None
+			for block_index in range(block_count - 1, -1, -1):
+				next_data_types[block_index] = next_data_type
+				if effective_types[block_index] != BLOCK_SILENT:
+					next_data_type = effective_types[block_index]
+
+			# What goes in the file of the current item, as segments of blocks and silent gaps
+			item_segments = []
+			item_numsamples = 0
 
 			# A clip can be made of many different blocks.
 			# The goal is to process them in order to get one file per clip,
 			# and then possibly splitting the clip or ignoring blocks.
 			# Another fun part is joining stereo tracks,
 			# because they are saved separately
-			for block_index, block in enumerate(blocks):
+			for block_index in range(block_count):
+
+				btype = effective_types[block_index]
+				is_last = block_index + 1 == block_count
+				is_next_different = not is_last and btype != effective_types[block_index + 1]
 
-				btype = block['type']
-				is_last = block_index + 1 == len(blocks)
-				is_next_different = not is_last and btype != blocks[block_index + 1]['type']
+				if btype == BLOCK_SIMPLE or btype == BLOCK_PCMALIAS:
+					if converted_numsamples == 0 and len(item_segments) == 0:
+						converted_clip_start = clip.offset + block_starts[block_index] / project.rate
+					converted_numsamples += block_lens[block_index]
 
-				if btype == 'simpleblockfile' or btype == 'pcmaliasblockfile':
-					if converted_numsamples == 0:
-						converted_clip_start = clip['offset'] + block['start'] / project['rate']
-					converted_numsamples += block['len']
+				if btype == BLOCK_SIMPLE:
+					filename = block_filenames[block_index]
 
-				if btype == 'simpleblockfile':
 					# This is mostly because I assume this rather than knowing it
-					assert block['filename'].endswith('.au')
-
-					block2 = None
-					if is_stereo_track and clip2 is not None:
-						for b in clip2['sequence']['blocks']:
-							if b['start'] == block['start'] and b['len'] == block['len']:
-								block2 = b
-								break
-
-					if block2 is not None:
-						src_fpath = indexed_files[block['filename']]
-						au_fpaths[0].append(src_fpath)
-						src_fpath2 = indexed_files[block2['filename']]
-						au_fpaths[1].append(src_fpath2)
+					assert project.db_path is not None or filename.endswith('.au')
+
+					if zero_blocks[block_index]:
+						# Only the other channel has sound
+						au_fpaths[0].append(None)
 					else:
-						src_fpath = indexed_files[block['filename']]
-						au_fpaths[0].append(src_fpath)
+						au_fpaths[0].append(block_paths[block_index])
+
+					if stereo_pairs is not None:
+						block2_index = stereo_pairs[block_index]
+						if block2_index != -1 and not zero_blocks2[block2_index]:
+							au_fpaths[1].append(block_paths2[block2_index])
+						else:
+							# Keep channels aligned, that block will be silent on the right
+							au_fpaths[1].append(None)
 
 					if is_last or is_next_different:
 
-						dst_fname = "track{0}_clip{1}.wav".format(track_index, len(converted_clips))
-						dst_fpath = os.path.join(target_dir, dst_fname)
+						item_segments.append(([list(au_fpaths[0]), list(au_fpaths[1])], converted_numsamples))
+						item_numsamples += converted_numsamples
+						au_fpaths[0].clear()
+						au_fpaths[1].clear()
+						converted_numsamples = 0
 
-						if os.path.isfile(dst_fpath):
-							print("Overwriting ", dst_fpath)
+						if settings.silence == 'sparse' and not is_last \
+							and effective_types[block_index + 1] == BLOCK_SILENT \
+							and next_data_types[block_index] == BLOCK_SIMPLE:
+							# The file goes on after the silence, which gets written as a gap
+							continue
+
+						# Clips made of the same blocks share the same file
+						src_key = (tuple((tuple(p[0]), tuple(p[1]), n) for p, n in item_segments), output_format)
+						location = locations_by_src_key.get(src_key)
+
+						if location is None:
+							if track_task is not None:
+								location = (track_task['dst_path'], track_task['numsamples'])
+								track_task['segments'] += item_segments
+								track_task['numsamples'] += item_numsamples
+
+							else:
+								dst_fname = "track{0}_clip{1}.wav".format(track_index, len(converted_clips))
+								location = (os.path.join(target_dir, dst_fname), 0)
+
+								# Actual conversion happens once we know about all clips
+								tasks.append({
+									'segments': item_segments,
+									'dst_path': location[0],
+									'numsamples': item_numsamples,
+									'format': output_format,
+									'dither': settings.dither,
+									'rate': track.rate
+								})
+
+							locations_by_src_key[src_key] = location
+
+						dst_fpath, file_start = location
+						if settings.consolidate:
+							converted_clips.append(ConvertedClip(converted_clip_start, item_numsamples,
+								dst_fpath, file_start, is_section=True))
+						else:
+							converted_clips.append(ConvertedClip(converted_clip_start, item_numsamples, dst_fpath))
 
-						# TODO Try to not duplicate files when the .au was re-used.
-						# We could do this by hashing au_fpaths, and if it's the same then use existing result
+						item_segments = []
+						item_numsamples = 0
 
-						samples_in_file = convert_au_files_to_wav(au_fpaths, dst_fpath)
+				elif btype == BLOCK_PCMALIAS:
+					# We don't do anything special regarding stereo, the source file should be fine already
 
-						# Check this because there is redundancy, I'm curious if that can fail
-						if samples_in_file != converted_numsamples:
-							print("WARNING: Sample count mismatch between what I found in the .aup and the actual files")
-							print("         .aup: {0}, file: {1}".format(total_samples, converted_numsamples))
+					if not is_last and block_types[block_index + 1] == BLOCK_PCMALIAS:
+						if block_filenames[block_index + 1] != block_filenames[block_index]:
+							is_next_different = True
 
-						converted_clips.append({
-							'offset': converted_clip_start,
-							'numsamples': converted_numsamples,
-							'filename': dst_fpath
-						})
+					if is_last or is_next_different:
+						converted_clips.append(ConvertedClip(converted_clip_start, converted_numsamples,
+							block_filenames[block_index], sequence.block_file_starts[block_index]))
 
-						au_fpaths[0].clear()
-						au_fpaths[1].clear()
 						converted_numsamples = 0
 
-				elif btype == 'pcmaliasblockfile':
-					# We don't do anything special regarding stereo, the source file should be fine already
+				elif btype == BLOCK_SILENT:
+					if len(item_segments) != 0:
+						# Gap in the middle of an item, made of a segment without blocks
+						if len(item_segments[-1][0][0]) == 0:
+							gap_paths, gap_numsamples = item_segments[-1]
+							item_segments[-1] = (gap_paths, gap_numsamples + block_lens[block_index])
+						else:
+							item_segments.append(([[], []], block_lens[block_index]))
+						item_numsamples += block_lens[block_index]
+					# Otherwise, this splits the clip into separate items
 
-					if not is_last:
-						next_block = blocks[block_index + 1]
-						if next_block['type'] == 'pcmaliasblockfile':
-							if next_block['filename'] != block['filename']:
-								is_next_different = True
+			if clip.trim_left != 0.0 or clip.trim_right != 0.0:
+				trim_converted_clips(converted_clips, first_converted_clip_index, clip, project.rate)
 
-					if is_last or is_next_different:
-						converted_clips.append({
-							'offset': converted_clip_start,
-							'numsamples': converted_numsamples,
-							'filename': block['filename'],
-							'file_start': block['file_start']
-						})
+		if track_task is not None and len(track_task['segments']) != 0:
+			tasks.append(track_task)
 
-						converted_numsamples = 0
+		# Put envelope points of all clips in time order
+		if len(envelope_runs) != 0:
+			envelope = merge_envelope_runs(envelope_runs)
+			if settings.envelope_tolerance > 0.0:
+				envelope = simplify_envelope(envelope, settings.envelope_tolerance)
+			converted_track.envelope = envelope
 
-				elif btype == 'silentblockfile':
-					pass # Ignore
+	block_files.save()
 
-				else:
-					print("WARNING: Unsupported block type: '{0}'".format(btype))
+	return tasks
+
+
+def prepare_incremental_conversion(tasks, target_dir, settings):
+	# Returns the manifest of target_dir, and which tasks actually need to run.
+	# The manifest is loaded even when rebuilding everything, so files it lists that are not used anymore still get removed.
+	manifest = ConversionManifest(target_dir)
+	manifest.load()
 
-		# Reorder envelope points by time
-		if 'envelope' in converted_track:
-			envelope = converted_track['envelope']
-			envelope['points'] = sorted(envelope['points'], key=lambda x: x['t'])
+	pending_tasks = []
 
+	for task in tasks:
+		if not settings.incremental or manifest.get_up_to_date_samples(task) is None:
+			pending_tasks.append(task)
+		elif settings.peaks and not os.path.isfile(task['dst_path'] + REAPEAKS_EXTENSION):
+			# Converted before without peaks
+			pending_tasks.append(task)
+
+	return manifest, pending_tasks
+
+
+def finish_incremental_conversion(manifest, tasks, pending_tasks, results):
+	# Records results of the tasks that ran and removes unreferenced files.
+	# Returns how many tasks failed.
+
+	failed_count = 0
+	for task, result in zip(pending_tasks, results):
+		if result['error'] is None:
+			manifest.record(task, result['samples'])
+		else:
+			failed_count += 1
 
-def write_rpp_file_from_audacity_project(fpath, project):
+	removed_count = manifest.remove_unreferenced([task['dst_path'] for task in tasks])
+	manifest.save()
+
+	print("Rebuilt {0} files, skipped {1} up-to-date, {2} failed, removed {3} unreferenced".format(
+		len(pending_tasks) - failed_count, len(tasks) - len(pending_tasks), failed_count, removed_count))
+
+	return failed_count
+
+
+def get_task_bytes_read(task):
+	# Size of the blocks a task converts
+	size = 0
+	for src_paths_by_channel, numsamples in task['segments']:
+		for src_paths in src_paths_by_channel:
+			for src_path in src_paths:
+				if src_path is not None:
+					size += get_block_size(src_path)
+	return size
+
+
+def run_conversion_task(task, settings, dst_f=None):
+	# Converts one clip. This runs in worker processes, so it reports failures instead of raising them.
+	# If dst_f is given, the file is written there from start to end instead of at its path,
+	# without cache or peaks (see convert_to_tar).
+	# Returns a dictionary with the number of samples in the file, an error message or None,
+	# how long it took, and how many bytes were read and written.
+
+	stats = ConversionStats()
+
+	result = {
+		'samples': 0,
+		'error': None,
+		'time': 0.0,
+		'bytes_read': 0,
+		'bytes_written': 0,
+		'blocks': 0,
+		'stages': stats.stages
+	}
+
+	start_time = time.perf_counter()
+
+	try:
+		dst_path = task['dst_path']
+
+		if dst_f is not None:
+			counts = convert_au_segments_to_wav(task['segments'], dst_path,
+				settings.max_buffer_size, task['format'], task['dither'], stats, settings.read_ahead, dst_f=dst_f)
+			if counts is None:
+				result['error'] = "could not convert blocks"
+			else:
+				result['samples'] = sum(counts)
+			result['bytes_read'] = get_task_bytes_read(task)
+			result['bytes_written'] = dst_f.tell()
+			return result
+
+		peaks_path = dst_path + REAPEAKS_EXTENSION if settings.peaks else None
+
+		# Don't write through an existing file, it may be a hard link to a cached one
+		if os.path.isfile(dst_path):
+			print("Overwriting ", dst_path)
+			os.remove(dst_path)
+		# Peaks would not match anymore
+		if os.path.isfile(dst_path + REAPEAKS_EXTENSION):
+			os.remove(dst_path + REAPEAKS_EXTENSION)
+
+		cache = settings.cache
+		samples_in_file = None
+
+		if cache is not None:
+			key = cache.get_key(task)
+			samples_in_file = cache.fetch(key, dst_path, peaks_path)
+
+		if samples_in_file is None:
+			counts = convert_au_segments_to_wav(task['segments'], dst_path,
+				settings.max_buffer_size, task['format'], task['dither'], stats, settings.read_ahead, peaks_path,
+				settings.silence == 'sparse')
+
+			if counts is None:
+				result['error'] = "could not convert blocks"
+				return result
+
+			samples_in_file = sum(counts)
+			result['bytes_read'] = get_task_bytes_read(task)
+
+			if cache is not None:
+				cache.store(key, dst_path, samples_in_file, peaks_path)
+
+		result['samples'] = samples_in_file
+		result['bytes_written'] = os.path.getsize(dst_path)
+
+	except Exception as e:
+		result['error'] = "{0}: {1}".format(type(e).__name__, e)
+
+	finally:
+		result['time'] = time.perf_counter() - start_time
+		result['blocks'] = stats.blocks
+		# Blocks may have been read by threads which are gone now
+		close_sqlite_connections()
+
+	return result
+
+
+def run_conversion_tasks(tasks, settings, stats=None):
+	# Runs clip conversions, on a process pool if more than one job is requested.
+	# Tasks are started in the given order, but results are gathered in task order,
+	# so what ends up in the project doesn't depend on scheduling.
+	# Results get merged into stats, which also reports progress, if given (see ConversionStats).
+	# Returns one result per task, see run_conversion_task.
+
+	if stats is None:
+		stats = ConversionStats()
+
+	jobs = settings.jobs
+	if jobs == 0:
+		jobs = os.cpu_count() or 1
+
+	total_samples = sum(task['numsamples'] for task in tasks)
+	done_samples = 0
+	done_count = 0
+
+	def on_task_done(task, result):
+		nonlocal done_samples, done_count
+		stats.add_task_result(result)
+		done_count += 1
+		done_samples += task['numsamples']
+		stats.report_progress(done_count, len(tasks), done_samples, total_samples)
+
+	with stats.measure('conversion'):
+		if jobs == 1 or len(tasks) <= 1:
+			results = []
+			for task in tasks:
+				result = run_conversion_task(task, settings)
+				on_task_done(task, result)
+				results.append(result)
+		else:
+			# Workers may be forked, they must not get our connections
+			close_sqlite_connections()
+			with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+				futures = [executor.submit(run_conversion_task, task, settings) for task in tasks]
+				tasks_by_future = dict(zip(futures, tasks))
+				for future in concurrent.futures.as_completed(futures):
+					on_task_done(tasks_by_future[future], future.result())
+				results = [future.result() for future in futures]
+
+	for task, result in zip(tasks, results):
+		report_conversion_task_result(task, result)
+
+	return results
+
+
+def report_conversion_task_result(task, result):
+	if result['error'] is not None:
+		print("ERROR: Failed to convert {0}: {1}".format(task['dst_path'], result['error']))
+
+	# Check this because there is redundancy, I'm curious if that can fail
+	elif result['samples'] != task['numsamples']:
+		print("WARNING: Sample count mismatch between what I found in the .aup and the actual files")
+		print("         {0}".format(task['dst_path']))
+		print("         .aup: {0}, file: {1}".format(task['numsamples'], result['samples']))
+
+
+def _format_rpp_string(v):
+	return '"' + v + '"'
+
+
+def _format_rpp_bool(v):
+	return '1' if v else '0'
+
+
+def _format_rpp_float(v):
+	# Fixed precision, so the same project always gives the same text
+	return '{0:.14g}'.format(v)
+
+
+def _format_rpp_uuid(v):
+	return '{' + str(v).upper() + '}'
+
+
+class RppWriter:
+	# Writes the text of a Reaper project.
+	# Lines are accumulated and written in large pieces, since projects can have a lot of small ones.
+
+	FORMATTERS = {
+		str: _format_rpp_string,
+		bool: _format_rpp_bool,
+		float: _format_rpp_float,
+		int: str,
+		uuid.UUID: _format_rpp_uuid
+	}
+
+	def __init__(self, f, buffer_size=1024 * 1024):
+		self.indent_unit = "  "
+		self.indent = ""
+		self.f = f
+		self.buffer_size = buffer_size
+		self._lines = []
+		self._buffered_size = 0
+
+	def open_block(self, tag, *args):
+		self._write_line(self.indent + '<' + tag, args)
+		self.indent += self.indent_unit
+
+	def close_block(self):
+		self.indent = self.indent[:-len(self.indent_unit)]
+		self._write_line(self.indent + '>', ())
+
+	def line(self, tag, *args):
+		self._write_line(self.indent + tag, args)
+
+	def _write_line(self, prefix, args):
+		if len(args) != 0:
+			formatters = self.FORMATTERS
+			prefix += ' ' + ' '.join([formatters.get(type(v), str)(v) for v in args])
+		self._lines.append(prefix)
+		self._buffered_size += len(prefix) + 1
+		if self._buffered_size >= self.buffer_size:
+			self.flush()
+
+	def flush(self):
+		if len(self._lines) != 0:
+			self._lines.append('')
+			self.f.write('\n'.join(self._lines))
+			self._lines.clear()
+			self._buffered_size = 0
+
+
+# Namespace of GUIDs derived from what they identify, see RppProjectWriter
+RPP_GUID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'https://github.com/Zylann/audacity2reaper')
+
+
+class RppProjectWriter:
+	# Writes a Reaper project one track at a time, so tracks can be written as they get converted:
+	# call begin(), then write_track() for each ConvertedTrack, then end().
+	# If deterministic_guids is True, GUIDs are derived from the project name and track/clip indices
+	# instead of being random, so converting the same project twice gives the same file.
 
 	audacity_color_to_peakcol = [
 		0, # 0: Default color in Audacity (blue)
@@ -607,11 +3287,25 @@ def write_rpp_file_from_audacity_project(fpath, project):
 		0x01222222 # 3: Black
 	]
 
+	def __init__(self, f, project_samplerate, project_name="", deterministic_guids=False):
+		self.w = RppWriter(f)
+		self.project_samplerate = int(project_samplerate)
+		self.project_name = project_name
+		self.deterministic_guids = deterministic_guids
+		self.track_count = 0
+
+	def _make_guid(self, *identity):
+		if self.deterministic_guids:
+			return uuid.uuid5(RPP_GUID_NAMESPACE, '/'.join(str(v) for v in (self.project_name,) + identity))
+		return uuid.uuid4()
+
+	@staticmethod
 	def get_file_tag(fname):
-		ext = os.path.splitext(fname)[1]
+		ext = os.path.splitext(fname)[1].lower()
 		if ext == '.wav':
+			# Also the tag of RF64 files, Reaper finds out which kind of WAV it is from the header
 			return 'WAVE'
-		elif ext == 'ogg':
+		elif ext == '.ogg':
 			return 'VORBIS'
 		return ext[1:].upper()
 
@@ -619,134 +3313,621 @@ def write_rpp_file_from_audacity_project(fpath, project):
 	# def linear2db(p_linear)
 	# 	return math.log(p_linear) * 8.6858896380650365530225783783321
 
-	class RppWriter:
-		def __init__(self, f):
-			self.indent_unit = "  "
-			self.indent = ""
-			self.f = f
-
-		def open_block(self, tag, *args):
-			self.f.write('{0}<{1}'.format(self.indent, tag))
-			self._args(args)
-			self.indent += self.indent_unit
-
-		def close_block(self):
-			self.indent = self.indent[:-len(self.indent_unit)]
-			self.f.write('{0}>\n'.format(self.indent))
-
-		def line(self, tag, *args):
-			self.f.write('{0}{1}'.format(self.indent, tag))
-			self._args(args)
-
-		def _args(self, args):
-			for v in args:
-				if type(v) == str:
-					s = ' "{0}"'# if v.contains(' ') else ' {0}'
-					self.f.write(s.format(v))
-				elif type(v) == bool:
-					self.f.write(' {0}'.format(1 if v else 0))
-				elif type(v) == uuid.UUID:
-					self.f.write(' {' + str(v).upper() + '}')
-				else:
-					self.f.write(' ' + str(v))
-			self.f.write('\n')
-
 	# One nice thing about Reaper projects is that you can omit things in it,
 	# it will not complain and just load what it finds, apparently
 
-	with open(fpath, 'w', encoding="utf-8") as f:
-		w = RppWriter(f)
+	def begin(self):
+		w = self.w
 
 		# Arbitrary version, which happens to be mine at time of writing.
 		# TODO I don't know what the number at the end is
 		w.open_block('REAPER_PROJECT', 0.1, '5.92/x64', 1534982487)
 
-		project_samplerate = int(project['rate'])
-		w.line('SAMPLERATE', project_samplerate, 0, 0)
+		w.line('SAMPLERATE', self.project_samplerate, 0, 0)
 
-		for track in project['converted_tracks']:
+	def write_track(self, track):
+		w = self.w
+		project_samplerate = self.project_samplerate
+		track_index = self.track_count
+		self.track_count += 1
 
-			track_uid = uuid.uuid4()
+		track_uid = self._make_guid('track', track_index)
 
-			w.open_block('TRACK', track_uid)
+		w.open_block('TRACK', track_uid)
 
-			w.line('NAME', track['name'])
-			w.line('TRACKID', track_uid)
-			w.line('VOLPAN', track['gain'], track['pan'], -1, -1, 1)
-			w.line('NCHAN', 2)
-			w.line('MUTESOLO', track['mute'], track['solo'])
-			w.line('PEAKCOL', audacity_color_to_peakcol[track['color_index']])
+		w.line('NAME', track.name)
+		w.line('TRACKID', track_uid)
+		w.line('VOLPAN', track.gain, track.pan, -1, -1, 1)
+		w.line('NCHAN', 2)
+		w.line('MUTESOLO', track.mute, track.solo)
+		w.line('PEAKCOL', self.audacity_color_to_peakcol[track.color_index])
 
-			if 'envelope' in track:
-				w.open_block('VOLENV2')
+		if track.envelope is not None:
+			w.open_block('VOLENV2')
 
-				for point in track['envelope']['points']:
-					w.line('PT', point['t'], point['val'])
+			for point in track.envelope:
+				w.line('PT', point.t, point.val)
 
-				w.close_block()
+			w.close_block()
 
-			for clip in track['converted_clips']:
+		for clip_index, clip in enumerate(track.clips):
 
-				w.open_block('ITEM')
+			w.open_block('ITEM')
 
-				w.line('POSITION', clip['offset'])
-				# TODO I don't know what these UIDs are
-				w.line('IGUID', uuid.uuid4())
-				w.line('GUID', uuid.uuid4())
-				w.line('NAME', os.path.basename(clip['filename']))
+			w.line('POSITION', clip.offset)
+			# TODO I don't know what these UIDs are
+			w.line('IGUID', self._make_guid('item', track_index, clip_index))
+			w.line('GUID', self._make_guid('take', track_index, clip_index))
+			w.line('NAME', os.path.basename(clip.filename))
 
-				nsamples = clip['numsamples']
-				item_len_seconds = nsamples / project_samplerate
+			nsamples = clip.numsamples
+			item_len_seconds = nsamples / project_samplerate
 
+			w.line('LENGTH', item_len_seconds)
+
+			# Note: sources like this can exist:
+			# <SOURCE SECTION
+			#   LENGTH 3.55565072008221
+			#   STARTPOS 7.40378238649376
+			#   OVERLAP 0.01
+			#   <SOURCE FLAC
+			#     FILE "D:\PROJETS\AUDIO\coproductions\1287\Episodes\Episode 7\foule_armee.flac"
+			#   >
+			# >
+			if clip.is_section:
+				w.open_block('SOURCE SECTION')
 				w.line('LENGTH', item_len_seconds)
+				w.line('STARTPOS', clip.file_start / project_samplerate)
 
-				if 'file_start' in clip:
-					w.line('SOFFS', clip['file_start'] / project_samplerate)
-				
-				w.open_block('SOURCE ' + get_file_tag(clip['filename']))
-				w.line('FILE', clip['filename'])
-				w.close_block()
+			elif clip.file_start is not None:
+				w.line('SOFFS', clip.file_start / project_samplerate)
 
-				# Note: sources like this can exist:
-				# <SOURCE SECTION
-				#   LENGTH 3.55565072008221
-				#   STARTPOS 7.40378238649376
-				#   OVERLAP 0.01
-				#   <SOURCE FLAC
-				#     FILE "D:\PROJETS\AUDIO\coproductions\1287\Episodes\Episode 7\foule_armee.flac"
-				#   >
-				# >
+			w.open_block('SOURCE ' + self.get_file_tag(clip.filename))
+			w.line('FILE', clip.filename)
+			w.close_block()
 
+			if clip.is_section:
 				w.close_block()
 
 			w.close_block()
 
 		w.close_block()
 
+	def end(self):
+		self.w.close_block()
+		self.w.flush()
+
+
+def write_rpp_from_audacity_project(f, project, deterministic_guids=False):
+	pw = RppProjectWriter(f, project.rate, project.name, deterministic_guids)
+	pw.begin()
+	for track in project.converted_tracks:
+		pw.write_track(track)
+	pw.end()
+
+
+def write_rpp_file_from_audacity_project(fpath, project, deterministic_guids=False):
+	with open(fpath, 'w', encoding="utf-8") as f:
+		write_rpp_from_audacity_project(f, project, deterministic_guids)
+
+
+class TarMemberFile:
+	# Where the content of a TarStreamWriter member gets written, like a file which can only be written in order.
+	# Seeking is only allowed to where it already is.
+
+	def __init__(self, archive, size):
+		self.archive = archive
+		self.size = size
+		self.written = 0
+
+	def write(self, data):
+		size = memoryview(data).nbytes
+		if self.written + size > self.size:
+			raise ValueError("Writing more than the {0} bytes announced in the tar header".format(self.size))
+		self.archive.write(data)
+		self.written += size
+		return size
+
+	def tell(self):
+		return self.written
+
+	def seek(self, pos, whence=os.SEEK_SET):
+		if whence == os.SEEK_CUR:
+			pos += self.written
+		if whence == os.SEEK_END or pos != self.written:
+			raise io.UnsupportedOperation("tar members can't be seeked")
+		return pos
+
+	def flush(self):
+		pass
+
+	def fileno(self):
+		# Makes copy_file_data go through Python
+		raise io.UnsupportedOperation("tar members have no file descriptor")
+
 
-def convert(aup_path):
-	project = load_audacity_project(aup_path)
+class TarStreamWriter:
+	# Writes a tar archive to a stream which doesn't need to be seekable, like stdout.
+	# The size of each member has to be known before writing it, since it goes in the header before the data.
+
+	def __init__(self, f):
+		self.f = f
+		self.size = 0
+		self.mtime = int(time.time())
+
+	def write(self, data):
+		self.f.write(data)
+		self.size += memoryview(data).nbytes
+
+	def _write_header(self, name, size, file_type=tarfile.REGTYPE, mode=0o644):
+		info = tarfile.TarInfo(name)
+		info.size = size
+		info.type = file_type
+		info.mode = mode
+		info.mtime = self.mtime
+		# PAX headers handle long names and files over 8 GB
+		self.write(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+
+	def _write_padding(self, block_size):
+		remainder = self.size % block_size
+		if remainder != 0:
+			self.write(bytes(block_size - remainder))
+
+	def add_directory(self, name):
+		self._write_header(name, 0, tarfile.DIRTYPE, 0o755)
+
+	def add_data(self, name, data):
+		self._write_header(name, len(data))
+		self.write(data)
+		self._write_padding(tarfile.BLOCKSIZE)
+
+	@contextlib.contextmanager
+	def open_member(self, name, size):
+		# Yields a TarMemberFile to write the content of a member in.
+		# What isn't written gets filled with zeros, so the archive stays valid.
+		self._write_header(name, size)
+		member = TarMemberFile(self, size)
+		try:
+			yield member
+		finally:
+			remaining = size - member.written
+			while remaining > 0:
+				count = min(remaining, COPY_BUFFER_SIZE)
+				self.write(bytes(count))
+				remaining -= count
+			self._write_padding(tarfile.BLOCKSIZE)
+
+	def close(self):
+		# The end of the archive is marked by two empty blocks, and it gets padded to a whole record like tarfile does
+		self.write(bytes(2 * tarfile.BLOCKSIZE))
+		self._write_padding(tarfile.RECORDSIZE)
+		self.f.flush()
+
+
+def load_audacity_project_to_convert(aup_path, settings):
+	# Loads a project, using the project cache if settings enable it
+	if settings is None or not settings.project_cache:
+		return load_audacity_project(aup_path)
+	data_dir, rpp_path = get_output_paths(aup_path)
+	return load_audacity_project(aup_path, os.path.join(data_dir, ProjectCache.FILENAME),
+		settings.refresh_project_cache or not settings.incremental)
+
+
+def get_output_paths(aup_path):
+	# Returns where converted audio files and the Reaper project go for that Audacity project
+	base_path = os.path.splitext(aup_path)[0]
+	return base_path + '_wav_data', base_path + '.rpp'
+
+
+def convert(aup_path, settings=None, stats=None):
+	# Measurements go into stats, if given (see ConversionStats)
+	# Returns False if the project could not be loaded or some of its clips failed to convert.
+	if stats is None:
+		stats = ConversionStats()
+
+	with stats.measure('load'):
+		project = load_audacity_project_to_convert(aup_path, settings)
+	if project is None:
+		print("ERROR: Could not load ", aup_path)
+		return False
 	# pp = pprint.PrettyPrinter(indent=4)
 	# pp.pprint(project)
 	# return
 
-	data_dir = os.path.splitext(aup_path)[0] + '_wav_data'
-	convert_au_files_from_audacity_project(project, data_dir)
+	data_dir, rpp_path = get_output_paths(aup_path)
+	# The Reaper project is still written when clips failed, they are reported and can be converted again later
+	failed_count = convert_au_files_from_audacity_project(project, data_dir, settings, stats)
+
+	with stats.measure('rpp'):
+		write_rpp_file_from_audacity_project(rpp_path, project, settings is not None and settings.deterministic_guids)
 
-	rpp_path = os.path.splitext(aup_path)[0] + '.rpp'
-	write_rpp_file_from_audacity_project(rpp_path, project)
+	close_sqlite_connections()
 
+	if failed_count != 0:
+		print("Done, {0} clips failed".format(failed_count))
+		return False
 	print("Done")
+	return True
+
+
+def find_audacity_projects(paths, list_fpath=None):
+	# Gathers .aup files from a mix of files and directories (searched recursively),
+	# plus an optional text file listing one path per line.
+	if list_fpath is not None:
+		paths = list(paths)
+		with open(list_fpath, 'r', encoding='utf-8') as f:
+			for line in f:
+				line = line.strip()
+				if line != '' and not line.startswith('#'):
+					paths.append(line)
+
+	aup_paths = []
+
+	for path in paths:
+		if os.path.isdir(path):
+			for root, dirs, files in os.walk(path):
+				dirs.sort()
+				for name in sorted(files):
+					if name.lower().endswith(('.aup', '.aup3')):
+						aup_paths.append(os.path.join(root, name))
+		else:
+			aup_paths.append(path)
+
+	return aup_paths
+
+
+def convert_batch(aup_paths, settings=None, stats=None):
+	# Converts many projects, scheduling clips from all of them on the same workers, largest first.
+	# Measurements go into stats, if given (see ConversionStats).
+	# Returns how many projects had errors.
+
+	if settings is None:
+		settings = ConversionSettings()
+	if stats is None:
+		stats = ConversionStats()
+
+	batch_items = []
+	all_tasks = []
+
+	for aup_path in aup_paths:
+		print("Loading ", aup_path)
+
+		item = {
+			'path': aup_path,
+			'error': None,
+			'time': 0.0,
+			'bytes_read': 0,
+			'bytes_written': 0,
+			'failed_count': 0
+		}
+		batch_items.append(item)
+
+		start_time = time.perf_counter()
+
+		try:
+			with stats.measure('load'):
+				project = load_audacity_project_to_convert(aup_path, settings)
+			if project is None:
+				raise ValueError("no project found")
+
+			data_dir, rpp_path = get_output_paths(aup_path)
+
+			with stats.measure('plan'):
+				tasks = plan_au_conversion(project, data_dir, settings)
+
+			# The Reaper project only depends on what was planned,
+			# so we can write it now and not keep all projects in memory
+			with stats.measure('rpp'):
+				write_rpp_file_from_audacity_project(rpp_path, project, settings.deterministic_guids)
+			project = None
+
+			with stats.measure('plan'):
+				manifest, pending_tasks = prepare_incremental_conversion(tasks, data_dir, settings)
+
+		except Exception as e:
+			print("ERROR: Failed to load {0}: {1}".format(aup_path, e))
+			item['error'] = "{0}: {1}".format(type(e).__name__, e)
+			continue
+
+		finally:
+			item['time'] += time.perf_counter() - start_time
+
+		item['tasks'] = tasks
+		item['manifest'] = manifest
+		item['pending_tasks'] = pending_tasks
+
+		for task in pending_tasks:
+			all_tasks.append((item, task))
+
+	# Biggest clips first, so the pool doesn't end up waiting on a big one started last
+	def get_task_size(item_and_task):
+		task = item_and_task[1]
+		# Segments always have a list for both channels, count those which have blocks
+		channels = get_segments_channel_count(task['segments'])[0]
+		return task['numsamples'] * channels
+
+	all_tasks.sort(key=get_task_size, reverse=True)
+
+	all_results = run_conversion_tasks([task for item, task in all_tasks], settings, stats)
+
+	results_by_task = {}
+	for (item, task), result in zip(all_tasks, all_results):
+		results_by_task[id(task)] = result
+		item['time'] += result['time']
+		item['bytes_read'] += result['bytes_read']
+		item['bytes_written'] += result['bytes_written']
+
+	for item in batch_items:
+		if item['error'] is not None:
+			continue
+		print(item['path'])
+		results = [results_by_task[id(task)] for task in item['pending_tasks']]
+		item['failed_count'] = finish_incremental_conversion(
+			item['manifest'], item['tasks'], item['pending_tasks'], results)
+
+	# Summary
+	print("")
+	print("{0:>10} {1:>12} {2:>12} {3:>7}  {4}".format('Time (s)', 'Read (MB)', 'Written (MB)', 'Failed', 'Project'))
+
+	error_count = 0
+	mb = 1024.0 * 1024.0
+
+	for item in batch_items:
+		if item['error'] is not None:
+			failed = 'load'
+		else:
+			failed = item['failed_count']
+		if failed != 0:
+			error_count += 1
+
+		print("{0:>10.2f} {1:>12.2f} {2:>12.2f} {3:>7}  {4}".format(
+			item['time'], item['bytes_read'] / mb, item['bytes_written'] / mb, failed, item['path']))
+
+	close_sqlite_connections()
+
+	print("Done, {0} projects, {1} with errors".format(len(batch_items), error_count))
+
+	return error_count
+
+
+def convert_to_tar(aup_paths, f, settings=None, stats=None):
+	# Converts projects into a tar archive written to f, which doesn't need to be seekable, so it can be stdout.
+	# Each project gets its .rpp and _wav_data folder at the root of the archive, like they would next to the .aup,
+	# and files are referred to relative to the .rpp, so they are found once extracted.
+	# WAV files go straight into the archive, their size is known in advance from sample counts.
+	# Nothing is written on disk, so there is no incremental conversion, cache, project cache or peak files,
+	# and clips are converted one after the other.
+	# Measurements go into stats, if given (see ConversionStats).
+	# Returns how many projects had errors.
+
+	if settings is None:
+		settings = ConversionSettings()
+	if stats is None:
+		stats = ConversionStats()
+
+	if settings.jobs != 1 or settings.cache is not None or settings.peaks or settings.project_cache:
+		print("WARNING: Jobs, cache, project cache and peaks are not used when converting into an archive")
+
+	archive = TarStreamWriter(f)
+	base_names = set()
+	error_count = 0
+
+	for aup_path in aup_paths:
+		print("Loading ", aup_path)
+
+		base_name = os.path.splitext(os.path.basename(aup_path))[0]
+		if base_name in base_names:
+			print("ERROR: A project named {0} is already in the archive, skipping {1}".format(base_name, aup_path))
+			error_count += 1
+			continue
+		base_names.add(base_name)
+
+		data_dir = base_name + '_wav_data'
+
+		try:
+			with stats.measure('load'):
+				project = load_audacity_project(aup_path)
+			if project is None:
+				raise ValueError("no project found")
+
+			with stats.measure('plan'):
+				tasks = plan_au_conversion(project, data_dir, settings, on_disk=False)
+
+			with stats.measure('rpp'):
+				rpp = io.StringIO()
+				write_rpp_from_audacity_project(rpp, project, settings.deterministic_guids)
+
+		except Exception as e:
+			print("ERROR: Failed to load {0}: {1}".format(aup_path, e))
+			error_count += 1
+			continue
+
+		archive.add_data(base_name + '.rpp', rpp.getvalue().encode('utf-8'))
+		rpp = None
+		if len(tasks) != 0:
+			archive.add_directory(data_dir)
+
+		total_samples = sum(task['numsamples'] for task in tasks)
+		done_samples = 0
+		failed_count = 0
+
+		with stats.measure('conversion'):
+			for task_index, task in enumerate(tasks):
+				nchannels, has_blocks = get_segments_channel_count(task['segments'])
+				bits_per_sample, is_float, typecode = OUTPUT_FORMATS[task['format']]
+				size = get_wav_file_size(nchannels, bits_per_sample, task['numsamples'])
+
+				with archive.open_member(task['dst_path'].replace(os.sep, '/'), size) as member:
+					result = run_conversion_task(task, settings, member)
+
+					if member.written == 0:
+						# Nothing could be converted, but the project refers to that file so it should be valid.
+						# Otherwise what wasn't written gets filled with zeros, which are silent samples.
+						w = WavWriter(member, task['rate'], nchannels, bits_per_sample, is_float, task['numsamples'])
+						w.append_silence(task['numsamples'])
+						w.finalize()
+
+				stats.add_task_result(result)
+				report_conversion_task_result(task, result)
+				if result['error'] is not None:
+					failed_count += 1
+
+				done_samples += task['numsamples']
+				stats.report_progress(task_index + 1, len(tasks), done_samples, total_samples)
+
+		print("Archived {0} files, {1} failed".format(len(tasks), failed_count))
+		if failed_count != 0:
+			error_count += 1
+
+	archive.close()
+	close_sqlite_connections()
+
+	print("Done, {0} projects, {1} with errors".format(len(aup_paths), error_count))
+
+	return error_count
 
 
 if __name__ == '__main__':
 
 	parser = argparse.ArgumentParser(description='Converts Audacity projects into Reaper projects.')
 
-	parser.add_argument('audacity_project', metavar='audacity_project', type=str, 
-		help='Path to the Audacity project to convert (.aup file)')
+	parser.add_argument('audacity_project', metavar='audacity_project', type=str, nargs='*',
+		help='Path to the Audacity project to convert (.aup or .aup3 file). '
+			'Several projects or directories containing projects can be given, which converts them as a batch.')
+
+	parser.add_argument('--from-list', type=str,
+		help='Text file listing Audacity projects or directories to convert as a batch, one per line')
+
+	parser.add_argument('--max-buffer-mb', type=float, default=DEFAULT_MAX_BUFFER_SIZE / (1024 * 1024),
+		help='Upper bound of memory used to hold samples while converting a clip, in megabytes')
+
+	parser.add_argument('-j', '--jobs', type=int, default=1,
+		help='Number of clips to convert in parallel. 0 uses all CPU cores.')
+
+	parser.add_argument('--cache-dir', type=str,
+		help='Directory where converted files are kept, so they can be reused by later conversions, '
+			'including of other projects')
+
+	parser.add_argument('--cache-size-mb', type=float,
+		help='Maximum size of the cache directory. Least recently used files are removed beyond that.')
+
+	parser.add_argument('--cache-hash-content', action='store_true',
+		help='Identify cached files by hashing the content of .au files, rather than their path, size and modification time. '
+			'Finds the same blocks in copies of a project, but requires reading them.')
+
+	parser.add_argument('--cache-by-name', action='store_true',
+		help='Identify cached files only by the name and size of .au files. Faster, but only safe when the cache '
+			'is used by a single project, since Audacity uses the same names in all projects.')
+
+	parser.add_argument('--rebuild-all', action='store_true',
+		help='Convert all clips again, even those whose blocks did not change since the last conversion')
+
+	parser.add_argument('--format', type=str, choices=sorted(OUTPUT_FORMATS.keys()),
+		help='Sample format of converted files. By default, the sample format of the Audacity project is kept.')
+
+	parser.add_argument('--dither', action='store_true',
+		help='Add dither noise when converting to a smaller integer sample format')
+
+	parser.add_argument('--consolidate', action='store_true',
+		help='Convert all clips of a track into a single file, which items refer to sections of. '
+			'This makes a lot less files for heavily edited projects.')
+
+	parser.add_argument('--deterministic-guids', action='store_true',
+		help='Derive GUIDs in the Reaper project from track and clip indices rather than making random ones, '
+			'so converting the same project again gives the same file')
+
+	parser.add_argument('--read-ahead', type=int, default=0,
+		help='Number of block files to read ahead while converting a clip, on as many threads. '
+			'Helps hiding latency of slow or network storage.')
+
+	parser.add_argument('--peaks', action='store_true',
+		help='Write Reaper peak files (.reapeaks) next to converted files, '
+			'so Reaper does not have to build them when opening the project')
+
+	parser.add_argument('--silence', type=str, choices=SILENCE_MODES, default='split',
+		help='What silent blocks in the middle of clips become: "split" makes separate items around them, '
+			'"sparse" keeps one file per clip, with silences left as holes which take no space on disk')
+
+	parser.add_argument('--envelope-tolerance', type=float, default=0.0, metavar='DB',
+		help='Remove volume envelope points as long as the envelope does not change by more than this many dB. '
+			'Makes projects with heavy automation lighter to load in Reaper. 0 keeps all points.')
+
+	parser.add_argument('--project-cache', action='store_true',
+		help='Save loaded projects in a binary form next to converted files, '
+			'so converting them again skips parsing as long as they did not change')
+
+	parser.add_argument('--refresh-project-cache', action='store_true',
+		help='Parse projects again even if they were saved with --project-cache, and replace what was saved')
+
+	parser.add_argument('--tar', type=str, metavar='PATH',
+		help='Write the Reaper project and converted files into a tar archive instead of next to the Audacity project, '
+			'without writing anything else on disk, so --jobs, --cache-dir, --project-cache and --peaks are ignored. '
+			'Use - to write it to the standard output.')
+
+	parser.add_argument('--stats', type=str, metavar='JSON_PATH',
+		help='Print how long each stage of the conversion took along with progress, '
+			'and save these measurements to a JSON file')
 
 	args = parser.parse_args()
 
-	convert(args.audacity_project)
+	settings = ConversionSettings()
+	settings.deterministic_guids = args.deterministic_guids
+	settings.consolidate = args.consolidate
+	settings.output_format = args.format
+	settings.dither = args.dither
+	settings.incremental = not args.rebuild_all
+	settings.max_buffer_size = int(args.max_buffer_mb * 1024 * 1024)
+	settings.jobs = args.jobs
+	settings.read_ahead = args.read_ahead
+	settings.peaks = args.peaks
+	settings.silence = args.silence
+	settings.envelope_tolerance = args.envelope_tolerance
+	settings.project_cache = args.project_cache or args.refresh_project_cache
+	settings.refresh_project_cache = args.refresh_project_cache
+
+	if args.cache_dir is not None:
+		cache_max_size = None if args.cache_size_mb is None else int(args.cache_size_mb * 1024 * 1024)
+		settings.cache = WavCache(args.cache_dir, cache_max_size, args.cache_hash_content, args.cache_by_name)
+
+	stats = None
+	if args.stats is not None:
+		def print_progress(done_count, total_count, elapsed, remaining):
+			eta = "?" if remaining is None else "{0:.0f}s".format(remaining)
+			print("Progress: {0}/{1} clips, {2:.0f}s elapsed, ETA {3}".format(done_count, total_count, elapsed, eta))
+
+		stats = ConversionStats(print_progress)
+
+	aup_paths = args.audacity_project
+	error_count = 0
+
+	with contextlib.ExitStack() as stack:
+		if args.tar is not None:
+			aup_paths = find_audacity_projects(aup_paths, args.from_list)
+			if len(aup_paths) == 0:
+				parser.error("no Audacity project to convert")
+
+			if args.tar == '-':
+				tar_f = sys.stdout.buffer
+				# Messages would end up in the archive
+				stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+			else:
+				tar_f = stack.enter_context(open(args.tar, 'wb'))
+
+			error_count = convert_to_tar(aup_paths, tar_f, settings, stats)
+
+		elif len(aup_paths) == 1 and args.from_list is None and not os.path.isdir(aup_paths[0]):
+			if not convert(aup_paths[0], settings, stats):
+				error_count = 1
+		else:
+			aup_paths = find_audacity_projects(aup_paths, args.from_list)
+			if len(aup_paths) == 0:
+				parser.error("no Audacity project to convert")
+			error_count = convert_batch(aup_paths, settings, stats)
+
+		if stats is not None:
+			stats.print_summary()
+			stats.save(args.stats)
+
+	if error_count != 0:
+		sys.exit(1)
 
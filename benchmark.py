@@ -0,0 +1,762 @@
+import struct
+import array
+import sys
+import io
+import contextlib
+import time
+import os
+import random
+import math
+import shutil
+import tempfile
+import sqlite3
+import argparse
+import json
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+try:
+	import resource
+except ImportError:
+	# Not available on Windows
+	resource = None
+
+import aup2rpp
+
+
+def write_au_file(fpath, samples, encoding, sample_rate=44100, swapped=False):
+	# Writes a block file the way Audacity's SimpleBlockFile does (no summary data)
+	little = (sys.byteorder == 'little') != swapped
+	bo = '<' if little else '>'
+
+	ss = aup2rpp.AU_SAMPLE_SIZES[encoding]
+	data_size = len(samples) * ss
+
+	with open(fpath, 'wb') as f:
+		f.write(struct.pack(bo + '6I', aup2rpp.AU_MAGIC, aup2rpp.AU_HEADER_SIZE,
+			data_size, encoding, sample_rate, 1))
+
+		if encoding == aup2rpp.AU_SAMPLE_FORMAT_24:
+			data = bytearray()
+			for v in samples:
+				d = struct.pack(bo + 'i', v)
+				data += d[:3] if little else d[1:]
+			f.write(data)
+		else:
+			f.write(struct.pack(bo + str(len(samples)) + aup2rpp.AU_SAMPLE_TYPECODES[encoding], *samples))
+
+
+def make_samples(count, encoding):
+	rng = random.Random(count)
+	if encoding == aup2rpp.AU_SAMPLE_FORMAT_16:
+		return [rng.randint(-32768, 32767) for i in range(count)]
+	if encoding == aup2rpp.AU_SAMPLE_FORMAT_24:
+		return [rng.randint(-8388608, 8388607) for i in range(count)]
+	return [rng.uniform(-1.0, 1.0) for i in range(count)]
+
+
+def load_au_file_per_sample(au_fpath):
+	# What load_au_file used to do: one read and one unpack per sample, into a list
+	with open(au_fpath, 'rb') as f:
+		hdata = struct.unpack('6I', f.read(24))
+		f.seek(hdata[1])
+		sfc, ss = ('h', 2) if hdata[3] == aup2rpp.AU_SAMPLE_FORMAT_16 else ('f', 4)
+		sample_data = []
+		while True:
+			d = f.read(ss)
+			if len(d) == 0:
+				break
+			sample_data.append(struct.unpack(sfc, d)[0])
+	return sample_data
+
+
+def write_synthetic_aup(fpath, track_count, clip_count, block_count, block_len=262144):
+	# Writes an .aup file referencing block files that don't exist, which is enough to measure loading.
+	# Written line by line, so it can be bigger than what we'd like to hold in memory.
+	with open(fpath, 'w', encoding='utf-8') as f:
+		f.write('<?xml version="1.0" standalone="no" ?>\n')
+		f.write('<project xmlns="http://audacity.sourceforge.net/xml/" projname="synthetic_data" '
+			'version="1.3.0" audacityversion="2.2.2" rate="44100">\n')
+
+		file_index = 0
+		for track_index in range(track_count):
+			f.write('\t<wavetrack name="Track {0}" channel="0" linked="0" mute="0" solo="0" height="150" '
+				'minimized="0" isSelected="1" rate="44100" gain="1.0" pan="0.0" colorindex="0">\n'.format(track_index))
+
+			for clip_index in range(clip_count):
+				f.write('\t\t<waveclip offset="{0:.8f}" colorindex="0">\n'.format(clip_index * 10.0))
+				f.write('\t\t\t<sequence maxsamples="262144" sampleformat="262159" numsamples="{0}">\n'.format(
+					block_count * block_len))
+
+				for block_index in range(block_count):
+					file_index += 1
+					f.write('\t\t\t\t<waveblock start="{0}">\n'.format(block_index * block_len))
+					f.write('\t\t\t\t\t<simpleblockfile filename="e{0:07x}.au" len="{1}" '
+						'min="-0.5" max="0.5" rms="0.25"/>\n'.format(file_index, block_len))
+					f.write('\t\t\t\t</waveblock>\n')
+
+				f.write('\t\t\t</sequence>\n')
+				f.write('\t\t\t<envelope numpoints="0"/>\n')
+				f.write('\t\t</waveclip>\n')
+
+			f.write('\t</wavetrack>\n')
+
+		f.write('</project>\n')
+
+# Audacity block file encoding and sequence `sampleformat` of each output format
+SYNTHETIC_SAMPLE_FORMATS = {
+	'int16': (aup2rpp.AU_SAMPLE_FORMAT_16, 0x00020001),
+	'int24': (aup2rpp.AU_SAMPLE_FORMAT_24, 0x00040001),
+	'float32': (aup2rpp.AU_SAMPLE_FORMAT_FLOAT, 0x0004000F)
+}
+
+
+def generate_synthetic_project(fpath, track_count=2, stereo=True, clip_count=2, block_count=4, block_len=65536,
+	sample_formats=('float32',), silent_every=0, pcmalias_every=0):
+	# Writes an .aup file along with its block files, laid out like Audacity does,
+	# so the whole conversion can run on it.
+	# Tracks cycle through sample_formats. If stereo is True, each track is a linked pair of channels.
+	# Every silent_every-th block is a silent block, and every pcmalias_every-th clip
+	# refers to an external WAV file instead of block files (0 disables either).
+	# Returns the total size of the generated block files in bytes.
+
+	base = os.path.splitext(fpath)[0]
+	data_dir = base + '_data'
+	alias_dir = base + '_alias'
+	os.makedirs(alias_dir, exist_ok=True)
+
+	# All blocks of the same format have the same content, generating them is slow.
+	# The first one is copied for the others.
+	template_paths_by_format = {}
+	file_index = 0
+	data_size = 0
+	channel_count = 2 if stereo else 1
+
+	with open(fpath, 'w', encoding='utf-8') as f:
+		f.write('<?xml version="1.0" standalone="no" ?>\n')
+		f.write('<project xmlns="http://audacity.sourceforge.net/xml/" projname="{0}" '
+			'version="1.3.0" audacityversion="2.2.2" rate="44100">\n'.format(os.path.basename(data_dir)))
+
+		for track_index in range(track_count):
+			sample_format = sample_formats[track_index % len(sample_formats)]
+			encoding, sequence_format = SYNTHETIC_SAMPLE_FORMATS[sample_format]
+
+			for channel in range(channel_count):
+				f.write('\t<wavetrack name="Track {0}" channel="{1}" linked="{2}" mute="0" solo="0" height="150" '
+					'minimized="0" isSelected="1" rate="44100" gain="1.0" pan="0.0" colorindex="0">\n'.format(
+					track_index, channel, 1 if stereo and channel == 0 else 0))
+
+				for clip_index in range(clip_count):
+					offset = clip_index * (block_count * block_len / 44100.0 + 1.0)
+					f.write('\t\t<waveclip offset="{0:.8f}" colorindex="0">\n'.format(offset))
+					f.write('\t\t\t<sequence maxsamples="262144" sampleformat="{0}" numsamples="{1}">\n'.format(
+						sequence_format, block_count * block_len))
+
+					is_alias = pcmalias_every > 0 and (clip_index + 1) % pcmalias_every == 0
+					alias_path = None
+					if is_alias:
+						alias_path = os.path.join(alias_dir, 'track{0}_clip{1}.wav'.format(track_index, clip_index))
+						if channel == 0:
+							write_alias_file(alias_path, block_count * block_len, channel_count)
+
+					for block_index in range(block_count):
+						start = block_index * block_len
+						f.write('\t\t\t\t<waveblock start="{0}">\n'.format(start))
+
+						if silent_every > 0 and (block_index + 1) % silent_every == 0:
+							f.write('\t\t\t\t\t<silentblockfile len="{0}"/>\n'.format(block_len))
+
+						elif is_alias:
+							f.write('\t\t\t\t\t<pcmaliasblockfile summaryfile="e{0:07x}.auf" aliasfile="{1}" '
+								'aliasstart="{2}" aliaslen="{3}" aliaschannel="{4}" min="-0.5" max="0.5" rms="0.25"/>\n'.format(
+								file_index, alias_path, start, block_len, channel))
+							file_index += 1
+
+						else:
+							# Audacity spreads files into eXX/dYY/ folders, named after their index
+							fname = 'e{0:07x}.au'.format(file_index)
+							dpath = os.path.join(data_dir, 'e' + fname[1:3], 'd' + fname[3:5])
+							os.makedirs(dpath, exist_ok=True)
+							bpath = os.path.join(dpath, fname)
+							template_path = template_paths_by_format.get(sample_format)
+							if template_path is None:
+								write_au_file(bpath, make_samples(block_len, encoding), encoding)
+								template_paths_by_format[sample_format] = bpath
+							else:
+								shutil.copyfile(template_path, bpath)
+							data_size += os.path.getsize(bpath)
+							file_index += 1
+
+							f.write('\t\t\t\t\t<simpleblockfile filename="{0}" len="{1}" '
+								'min="-0.5" max="0.5" rms="0.25"/>\n'.format(fname, block_len))
+
+						f.write('\t\t\t\t</waveblock>\n')
+
+					f.write('\t\t\t</sequence>\n')
+					f.write('\t\t\t<envelope numpoints="2">\n')
+					f.write('\t\t\t\t<controlpoint t="{0:.8f}" val="0.5"/>\n'.format(offset + 0.1))
+					f.write('\t\t\t\t<controlpoint t="{0:.8f}" val="1.0"/>\n'.format(offset + 0.5))
+					f.write('\t\t\t</envelope>\n')
+					f.write('\t\t</waveclip>\n')
+
+				f.write('\t</wavetrack>\n')
+
+		f.write('</project>\n')
+
+	return data_size
+
+
+class BinaryXmlWriter:
+	# Writes XML in the binary form Audacity 3 saves projects in, see aup2rpp.parse_binary_xml.
+	# Attributes are given as (name, value) pairs, their type decides how they are stored.
+
+	def __init__(self, char_size=4):
+		self.encoding = aup2rpp._BINARY_XML_ENCODINGS[char_size]
+		self.dict = bytearray([aup2rpp.FT_CHAR_SIZE, char_size])
+		self.doc = bytearray()
+		self.name_ids = {}
+
+	def _get_name_id(self, name):
+		name_id = self.name_ids.get(name)
+		if name_id is None:
+			name_id = len(self.name_ids)
+			self.name_ids[name] = name_id
+			data = name.encode(self.encoding)
+			self.dict += struct.pack('<BHH', aup2rpp.FT_NAME, name_id, len(data)) + data
+		return name_id
+
+	def start(self, tag, attrib=()):
+		self.doc += struct.pack('<BH', aup2rpp.FT_START_TAG, self._get_name_id(tag))
+		for name, value in attrib:
+			name_id = self._get_name_id(name)
+			if isinstance(value, bool):
+				self.doc += struct.pack('<BHB', aup2rpp.FT_BOOL, name_id, value)
+			elif isinstance(value, int):
+				if -0x80000000 <= value < 0x80000000:
+					self.doc += struct.pack('<BHi', aup2rpp.FT_INT, name_id, value)
+				else:
+					self.doc += struct.pack('<BHq', aup2rpp.FT_LONG_LONG, name_id, value)
+			elif isinstance(value, float):
+				self.doc += struct.pack('<BHdi', aup2rpp.FT_DOUBLE, name_id, value, 19)
+			else:
+				data = value.encode(self.encoding)
+				self.doc += struct.pack('<BHi', aup2rpp.FT_STRING, name_id, len(data)) + data
+
+	def end(self, tag):
+		self.doc += struct.pack('<BH', aup2rpp.FT_END_TAG, self._get_name_id(tag))
+
+
+# Tables of Audacity 3 projects we use, see ProjectFileIO.cpp
+AUP3_SCHEMA = """
+	CREATE TABLE project (id INTEGER PRIMARY KEY, dict BLOB, doc BLOB);
+	CREATE TABLE autosave (id INTEGER PRIMARY KEY, dict BLOB, doc BLOB);
+	CREATE TABLE sampleblocks (
+		blockid INTEGER PRIMARY KEY AUTOINCREMENT,
+		sampleformat INTEGER,
+		summin REAL,
+		summax REAL,
+		sumrms REAL,
+		summary256 BLOB,
+		summary64k BLOB,
+		samples BLOB);
+"""
+
+
+def generate_synthetic_aup3(fpath, track_count=2, stereo=True, clip_count=2, block_count=4, block_len=65536,
+	sample_formats=('float32',), silent_every=0, trim=0.0):
+	# Writes an Audacity 3 project with the same content generate_synthetic_project would give,
+	# except pcmalias blocks which don't exist anymore. If trim is given, clips hide that many seconds on both ends.
+	# Returns the total size of sample blobs in bytes.
+
+	if os.path.isfile(fpath):
+		os.remove(fpath)
+
+	connection = sqlite3.connect(fpath)
+	connection.executescript(AUP3_SCHEMA)
+
+	samples_by_format = {}
+	data_size = 0
+	channel_count = 2 if stereo else 1
+	w = BinaryXmlWriter()
+
+	w.start('project', [('version', '1.3.0'), ('audacityversion', '3.0.2'), ('rate', 44100.0)])
+
+	for track_index in range(track_count):
+		sample_format = sample_formats[track_index % len(sample_formats)]
+		encoding, sequence_format = SYNTHETIC_SAMPLE_FORMATS[sample_format]
+
+		samples = samples_by_format.get(sample_format)
+		if samples is None:
+			samples = array.array(aup2rpp.AU_SAMPLE_TYPECODES[encoding], make_samples(block_len, encoding))
+			samples_by_format[sample_format] = samples
+		scale = aup2rpp._INTEGER_FORMAT_SCALES.get(sample_format, 1.0)
+		summary = (min(samples) / scale, max(samples) / scale,
+			math.sqrt(sum(v * v for v in samples) / len(samples)) / scale)
+
+		for channel in range(channel_count):
+			w.start('wavetrack', [('name', 'Track {0}'.format(track_index)), ('channel', channel),
+				('linked', 1 if stereo and channel == 0 else 0), ('mute', False), ('solo', False),
+				('rate', 44100), ('gain', 1.0), ('pan', 0.0), ('colorindex', 0)])
+
+			for clip_index in range(clip_count):
+				offset = clip_index * (block_count * block_len / 44100.0 + 1.0)
+				w.start('waveclip', [('offset', offset), ('trimLeft', trim), ('trimRight', trim), ('name', ''),
+					('colorindex', 0)])
+				w.start('sequence', [('maxsamples', 262144), ('sampleformat', sequence_format),
+					('numsamples', block_count * block_len)])
+
+				for block_index in range(block_count):
+					start = block_index * block_len
+
+					if silent_every > 0 and (block_index + 1) % silent_every == 0:
+						blockid = -block_len
+					else:
+						cursor = connection.execute('INSERT INTO sampleblocks '
+							'(sampleformat, summin, summax, sumrms, summary256, summary64k, samples) '
+							'VALUES (?, ?, ?, ?, ?, ?, ?)',
+							(sequence_format,) + summary + (b'', b'', samples.tobytes()))
+						blockid = cursor.lastrowid
+						data_size += len(samples) * samples.itemsize
+
+					w.start('waveblock', [('start', start), ('blockid', blockid)])
+					w.end('waveblock')
+
+				w.end('sequence')
+				w.start('envelope', [('numpoints', 2)])
+				for t, val in ((offset + 0.1, 0.5), (offset + 0.5, 1.0)):
+					w.start('controlpoint', [('t', t), ('val', val)])
+					w.end('controlpoint')
+				w.end('envelope')
+				w.end('waveclip')
+
+			w.end('wavetrack')
+
+	w.end('project')
+
+	connection.execute('INSERT INTO project (id, dict, doc) VALUES (1, ?, ?)', (bytes(w.dict), bytes(w.doc)))
+	connection.commit()
+	connection.close()
+
+	return data_size
+
+
+def write_alias_file(fpath, numsamples, channel_count):
+	# pcmalias blocks only refer to the file, so its content doesn't matter
+	with open(fpath, 'wb') as f:
+		writer = aup2rpp.WavWriter(f, 44100, channel_count, 16)
+		writer.append_silence(numsamples)
+		writer.finalize()
+
+
+def load_audacity_project_from_tree(fpath):
+	# Builds the same project, but from the whole element tree like load_audacity_project used to
+	root = ET.parse(fpath).getroot()
+	builder = aup2rpp.AudacityProjectBuilder("")
+
+	def visit(elem):
+		tag = elem.tag.rsplit('}', 1)[-1]
+		builder.start(tag, elem.attrib)
+		for child in elem:
+			visit(child)
+		builder.end(tag)
+
+	visit(root)
+	return builder.project
+
+
+def make_synthetic_sequence(block_count, block_len=262144, prefix='e'):
+	sequence = aup2rpp.Sequence(262144, 262159, block_count * block_len)
+	for i in range(block_count):
+		sequence.append_block(aup2rpp.BLOCK_SIMPLE, i * block_len, block_len, '{0}{1:07x}.au'.format(prefix, i))
+	return sequence
+
+
+def pair_stereo_blocks_by_scan(sequence, sequence2):
+	# What the conversion used to do: scan the whole other channel for each block
+	pairs = []
+	for i in range(sequence.get_block_count()):
+		j = -1
+		for k in range(sequence2.get_block_count()):
+			if sequence2.block_starts[k] == sequence.block_starts[i] and sequence2.block_lens[k] == sequence.block_lens[i]:
+				j = k
+				break
+		pairs.append(j)
+	return pairs
+
+
+def measure_peak_memory(func, *args):
+	# Returns the peak of memory allocated by Python while running func, in bytes
+	tracemalloc.start()
+	try:
+		func(*args)
+		return tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+
+def timed(func, *args):
+	t = time.perf_counter()
+	# Silence logging, it's not what we measure
+	with contextlib.redirect_stdout(io.StringIO()):
+		func(*args)
+	return time.perf_counter() - t
+
+
+def run_quietly(func, *args):
+	# Like timed, but also returns what func returned
+	t = time.perf_counter()
+	with contextlib.redirect_stdout(io.StringIO()):
+		result = func(*args)
+	return time.perf_counter() - t, result
+
+
+def get_peak_rss():
+	# Returns the peak resident memory of this process in bytes, or None if we can't know
+	if resource is None:
+		return None
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Kilobytes on Linux, bytes on macOS
+	return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def bench_au_decoding(tmp_dir, block_count, block_len):
+	for name, encoding in [('int16', aup2rpp.AU_SAMPLE_FORMAT_16), ('float', aup2rpp.AU_SAMPLE_FORMAT_FLOAT)]:
+		samples = make_samples(block_len, encoding)
+		fpaths = []
+		for i in range(block_count):
+			fpath = os.path.join(tmp_dir, 'b{0}_{1}.au'.format(name, i))
+			write_au_file(fpath, samples, encoding)
+			fpaths.append(fpath)
+
+		mb = block_count * block_len * aup2rpp.AU_SAMPLE_SIZES[encoding] / (1024.0 * 1024.0)
+
+		t_old = sum(timed(load_au_file_per_sample, fpath) for fpath in fpaths)
+		t_new = sum(timed(aup2rpp.load_au_file, fpath) for fpath in fpaths)
+
+		print("load_au_file {0:6}: per-sample {1:8.2f} MB/s, bulk {2:8.2f} MB/s (x{3:.1f})".format(
+			name, mb / t_old, mb / t_new, t_old / t_new))
+
+
+def bench_project_loading(tmp_dir, block_counts):
+	mb = 1024.0 * 1024.0
+
+	for block_count in block_counts:
+		fpath = os.path.join(tmp_dir, 'synthetic_{0}.aup'.format(block_count))
+		write_synthetic_aup(fpath, 1, 1, block_count)
+		size = os.path.getsize(fpath)
+
+		t_tree = timed(load_audacity_project_from_tree, fpath)
+		t_stream = timed(aup2rpp.load_audacity_project, fpath)
+		m_tree = measure_peak_memory(load_audacity_project_from_tree, fpath)
+		m_stream = measure_peak_memory(aup2rpp.load_audacity_project, fpath)
+
+		cache_path = os.path.join(tmp_dir, aup2rpp.ProjectCache.FILENAME)
+		aup2rpp.load_audacity_project(fpath, cache_path)
+		t_cached = timed(aup2rpp.load_audacity_project, fpath, cache_path)
+
+		print("load_audacity_project {0:8} blocks ({1:7.2f} MB): "
+			"whole tree {2:6.2f}s, peak {3:8.2f} MB | streamed {4:6.2f}s, peak {5:8.2f} MB | cached {6:6.2f}s".format(
+			block_count, size / mb, t_tree, m_tree / mb, t_stream, m_stream / mb, t_cached))
+
+		os.remove(fpath)
+		os.remove(cache_path)
+
+
+def bench_stereo_pairing(block_counts, max_scanned_block_count=10000):
+	for block_count in block_counts:
+		sequence = make_synthetic_sequence(block_count, prefix='e')
+		sequence2 = make_synthetic_sequence(block_count, prefix='f')
+
+		t_indexed = timed(aup2rpp.pair_stereo_blocks, sequence, sequence2)
+
+		if block_count <= max_scanned_block_count:
+			t_scan = timed(pair_stereo_blocks_by_scan, sequence, sequence2)
+			scan_desc = "{0:8.3f}s".format(t_scan)
+		else:
+			scan_desc = "(skipped)"
+
+		print("pair_stereo_blocks {0:8} blocks per channel: scan {1}, indexed {2:8.3f}s".format(
+			block_count, scan_desc, t_indexed))
+
+
+def make_synthetic_envelope_runs(point_count, clip_count=100):
+	# Per-clip envelopes as the planner gets them, one after the other
+	runs = []
+	points_per_clip = point_count // clip_count
+	for clip_index in range(clip_count):
+		t0 = clip_index * points_per_clip * 0.01
+		runs.append([aup2rpp.EnvelopePoint(t0 + i * 0.01, 0.5 + 0.4 * math.sin(i / 50.0))
+			for i in range(points_per_clip)])
+	return runs
+
+
+def sort_envelope_runs(runs):
+	# How points were put in order before runs got merged
+	points = [p for run in runs for p in run]
+	points.sort(key=lambda p: p.t)
+	return points
+
+
+def bench_envelopes(point_counts, tolerance):
+	for point_count in point_counts:
+		runs = make_synthetic_envelope_runs(point_count)
+
+		t_sort = timed(sort_envelope_runs, runs)
+		t_merge = timed(aup2rpp.merge_envelope_runs, runs)
+
+		points = aup2rpp.merge_envelope_runs(runs)
+		t_simplify = timed(aup2rpp.simplify_envelope, points, tolerance)
+		kept_count = len(aup2rpp.simplify_envelope(points, tolerance))
+
+		print("envelope {0:8} points: sort {1:6.3f}s, merge {2:6.3f}s | simplify to {3} dB {4:6.3f}s, "
+			"{5} points kept".format(point_count, t_sort, t_merge, tolerance, t_simplify, kept_count))
+
+
+PEAK_FORMAT_ENCODINGS = {
+	'int16': aup2rpp.AU_SAMPLE_FORMAT_16,
+	'int24': aup2rpp.AU_SAMPLE_FORMAT_24,
+	'float32': aup2rpp.AU_SAMPLE_FORMAT_FLOAT
+}
+
+
+def build_reapeaks(fpath, wav_path, output_format, blocks):
+	# Feeds blocks of stereo samples to a PeakBuilder, the right channel is silent every other block
+	peaks = aup2rpp.PeakBuilder(2, 44100, output_format)
+	for i, samples in enumerate(blocks):
+		# Odd sizes, so windows straddle blocks
+		nsamples = len(samples) - 7
+		peaks.add_samples([samples, None if i % 2 else samples], nsamples)
+	peaks.save(fpath, wav_path)
+
+
+def bench_peaks(tmp_dir, block_count, block_len):
+	# Builds .reapeaks files with and without NumPy, and checks both give the same result.
+	# Returns the formats for which they differ.
+	mismatches = []
+	wav_path = os.path.join(tmp_dir, 'peaks_source.wav')
+	with open(wav_path, 'wb') as f:
+		f.write(b'RIFF')
+
+	for output_format, encoding in sorted(PEAK_FORMAT_ENCODINGS.items()):
+		typecode = aup2rpp.OUTPUT_FORMATS[output_format][2]
+		blocks = [array.array(typecode, make_samples(block_len + i, encoding)) for i in range(block_count)]
+
+		python_path = os.path.join(tmp_dir, 'peaks_python.reapeaks')
+		numpy_module = aup2rpp.numpy
+		aup2rpp.numpy = None
+		try:
+			t_python = timed(build_reapeaks, python_path, wav_path, output_format, blocks)
+		finally:
+			aup2rpp.numpy = numpy_module
+
+		if numpy_module is None:
+			print("peaks {0:8}: python {1:8.3f}s, numpy (not installed)".format(output_format, t_python))
+			continue
+
+		numpy_path = os.path.join(tmp_dir, 'peaks_numpy.reapeaks')
+		t_numpy = timed(build_reapeaks, numpy_path, wav_path, output_format, blocks)
+
+		same = aup2rpp.read_file_data(python_path) == aup2rpp.read_file_data(numpy_path)
+		if not same:
+			mismatches.append(output_format)
+		print("peaks {0:8}: python {1:8.3f}s, numpy {2:8.3f}s, {3}".format(
+			output_format, t_python, t_numpy, "same output" if same else "DIFFERENT OUTPUT"))
+
+	return mismatches
+
+
+def bench_pipeline(tmp_dir, args):
+	# Converts a synthetic project and measures each stage on its own, keeping the best of a few runs.
+	# Returns throughputs in MB/s by stage name.
+
+	mb = 1024.0 * 1024.0
+
+	if args.aup3:
+		aup_path = os.path.join(tmp_dir, 'pipeline.aup3')
+		data_size = generate_synthetic_aup3(aup_path,
+			track_count=args.tracks,
+			stereo=not args.mono,
+			clip_count=args.clips,
+			block_count=args.blocks,
+			block_len=args.block_len,
+			sample_formats=args.formats,
+			silent_every=args.silent_every)
+		# Only count the project itself, not samples
+		project_size = os.path.getsize(aup_path) - data_size
+	else:
+		aup_path = os.path.join(tmp_dir, 'pipeline.aup')
+		data_size = generate_synthetic_project(aup_path,
+			track_count=args.tracks,
+			stereo=not args.mono,
+			clip_count=args.clips,
+			block_count=args.blocks,
+			block_len=args.block_len,
+			sample_formats=args.formats,
+			silent_every=args.silent_every,
+			pcmalias_every=args.pcmalias_every)
+		project_size = os.path.getsize(aup_path)
+
+	target_dir, rpp_path = aup2rpp.get_output_paths(aup_path)
+	settings = aup2rpp.ConversionSettings()
+
+	def best_of(func, *fargs):
+		best_time = None
+		result = None
+		for i in range(args.repeat):
+			t, result = run_quietly(func, *fargs)
+			if best_time is None or t < best_time:
+				best_time = t
+		return best_time, result
+
+	t_load, project = best_of(aup2rpp.load_audacity_project, aup_path)
+
+	t_plan, tasks = run_quietly(aup2rpp.plan_au_conversion, project, target_dir, settings)
+
+	t_convert, results = best_of(aup2rpp.run_conversion_tasks, tasks, settings)
+	failed = sum(1 for result in results if result['error'] is not None)
+	if failed != 0:
+		print("ERROR: {0} conversion tasks failed".format(failed))
+	written_size = sum(result['bytes_written'] for result in results)
+
+	# Same amount of samples as the conversion wrote, minus reading and decoding
+	wav_path = os.path.join(tmp_dir, 'pipeline_writer.wav')
+	wav_samples = make_samples(args.block_len, aup2rpp.AU_SAMPLE_FORMAT_FLOAT)
+	wav_samples = array.array('f', wav_samples)
+	channel_count = 1 if args.mono else 2
+	total_samples = args.tracks * args.clips * args.blocks * args.block_len
+
+	def write_wav():
+		with open(wav_path, 'wb') as f:
+			writer = aup2rpp.WavWriter(f, 44100, channel_count, 32, True)
+			for i in range(total_samples // args.block_len):
+				writer.append_multichannel_samples([wav_samples] * channel_count)
+			writer.finalize()
+
+	t_wav, _ = best_of(write_wav)
+	wav_size = os.path.getsize(wav_path)
+
+	t_rpp, _ = best_of(aup2rpp.write_rpp_file_from_audacity_project, rpp_path, project)
+
+	stages = [
+		('load', project_size, t_load),
+		('plan', project_size, t_plan),
+		('convert', data_size, t_convert),
+		('wav_writer', wav_size, t_wav),
+		('rpp', os.path.getsize(rpp_path), t_rpp)
+	]
+
+	throughputs = {}
+	print("Pipeline: {0} tracks, {1} clips, {2} blocks of {3} samples, {4} of block files, {5} written".format(
+		args.tracks, args.clips, args.blocks, args.block_len,
+		"{0:.2f} MB".format(data_size / mb), "{0:.2f} MB".format(written_size / mb)))
+
+	for name, size, t in stages:
+		throughputs[name] = size / mb / t
+		print("  {0:12} {1:9.3f}s {2:10.2f} MB/s".format(name, t, throughputs[name]))
+
+	peak_rss = get_peak_rss()
+	if peak_rss is not None:
+		print("  peak RSS     {0:9.2f} MB".format(peak_rss / mb))
+
+	return throughputs
+
+
+def check_regressions(throughputs, baseline, threshold):
+	# Returns the names of stages that got slower than the baseline by more than threshold (a ratio)
+	regressions = []
+	for name, value in sorted(throughputs.items()):
+		reference = baseline.get(name)
+		if reference is None:
+			continue
+		ratio = value / reference
+		status = "ok"
+		if ratio < 1.0 - threshold:
+			status = "REGRESSION"
+			regressions.append(name)
+		print("  {0:12} {1:10.2f} MB/s, baseline {2:10.2f} MB/s ({3:+.0%}) {4}".format(
+			name, value, reference, ratio - 1.0, status))
+	return regressions
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Measures the throughput of aup2rpp on synthetic data.')
+
+	parser.add_argument('--blocks', type=int, default=20,
+		help='Number of .au block files to generate for decoding, and per clip in the pipeline benchmark')
+	parser.add_argument('--block-len', type=int, default=262144,
+		help='Number of samples in each block file')
+	parser.add_argument('--tracks', type=int, default=2,
+		help='Number of tracks in the synthetic project of the pipeline benchmark')
+	parser.add_argument('--clips', type=int, default=4,
+		help='Number of clips per track in the synthetic project')
+	parser.add_argument('--mono', action='store_true',
+		help='Make mono tracks instead of linked stereo pairs')
+	parser.add_argument('--formats', nargs='+', default=['int16', 'int24', 'float32'],
+		choices=sorted(SYNTHETIC_SAMPLE_FORMATS.keys()),
+		help='Sample formats of tracks, used in turn')
+	parser.add_argument('--silent-every', type=int, default=0,
+		help='Make every Nth block of a clip silent')
+	parser.add_argument('--pcmalias-every', type=int, default=0,
+		help='Make every Nth clip refer to an external file through pcmalias blocks')
+	parser.add_argument('--aup3', action='store_true',
+		help='Generate an Audacity 3 project (.aup3) instead of an .aup file with block files')
+	parser.add_argument('--repeat', type=int, default=3,
+		help='Number of runs of each pipeline stage, the best one is kept')
+	parser.add_argument('--pipeline-only', action='store_true',
+		help='Only run the pipeline benchmark')
+	parser.add_argument('--peaks-only', action='store_true',
+		help='Only build peaks with and without NumPy, and exit with an error if they differ')
+	parser.add_argument('--save-baseline', metavar='PATH',
+		help='Save pipeline throughputs to a JSON file, to compare later runs against')
+	parser.add_argument('--baseline', metavar='PATH',
+		help='Compare pipeline throughputs to a saved baseline, and exit with an error if a stage regressed')
+	parser.add_argument('--threshold', type=float, default=0.2,
+		help='How much slower than the baseline a stage can get before it counts as a regression (ratio)')
+	parser.add_argument('--aup-blocks', type=int, nargs='+', default=[10000, 100000],
+		help='Numbers of blocks in the synthetic .aup files used to measure project loading')
+	parser.add_argument('--stereo-blocks', type=int, nargs='+', default=[1000, 10000, 100000],
+		help='Numbers of blocks per channel used to measure stereo block pairing. '
+			'The old quadratic scan is only measured up to 10000.')
+
+	parser.add_argument('--envelope-points', type=int, nargs='+', default=[100000, 1000000],
+		help='Numbers of volume envelope points per track used to measure merging and simplifying envelopes')
+	parser.add_argument('--envelope-tolerance', type=float, default=0.1,
+		help='Tolerance in dB used to measure simplifying envelopes')
+
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		if args.peaks_only:
+			peak_mismatches = bench_peaks(tmp_dir, args.blocks, args.block_len)
+			if len(peak_mismatches) != 0:
+				print("ERROR: Peaks built with NumPy differ in: {0}".format(', '.join(peak_mismatches)))
+			sys.exit(1 if len(peak_mismatches) != 0 else 0)
+
+		peak_mismatches = []
+		if not args.pipeline_only:
+			bench_au_decoding(tmp_dir, args.blocks, args.block_len)
+			bench_project_loading(tmp_dir, args.aup_blocks)
+			bench_stereo_pairing(args.stereo_blocks)
+			bench_envelopes(args.envelope_points, args.envelope_tolerance)
+			peak_mismatches = bench_peaks(tmp_dir, args.blocks, args.block_len)
+
+		throughputs = bench_pipeline(tmp_dir, args)
+
+	if args.save_baseline is not None:
+		with open(args.save_baseline, 'w', encoding='utf-8') as f:
+			json.dump(throughputs, f, indent=4, sort_keys=True)
+		print("Saved baseline to", args.save_baseline)
+
+	if args.baseline is not None:
+		with open(args.baseline, 'r', encoding='utf-8') as f:
+			baseline = json.load(f)
+		print("Compared to", args.baseline)
+		regressions = check_regressions(throughputs, baseline, args.threshold)
+		if len(regressions) != 0:
+			print("ERROR: Performance regressed in: {0}".format(', '.join(regressions)))
+			sys.exit(1)
+
+	if len(peak_mismatches) != 0:
+		print("ERROR: Peaks built with NumPy differ in: {0}".format(', '.join(peak_mismatches)))
+		sys.exit(1)